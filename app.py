@@ -1,19 +1,84 @@
 """Blogly application."""
 
-from flask import Flask, render_template, redirect, request, flash
+import os
+from datetime import datetime
+from flask import Flask, render_template, redirect, request, flash, \
+    Response, stream_with_context, get_flashed_messages
 from flask_debugtoolbar import DebugToolbarExtension
 from models import db, connect_db, User, Post, Tag, PostTag
+from migrations import bootstrap, upgrade, find_unindexed_foreign_keys
+from feeds import feed_cache, feed_keys, write_feed, ATOM_MIMETYPE, FEED_SIZE
+from related import related_posts, sync_related_posts, \
+    related_posts_changed
+from tag_index import tag_index, sync_tag_index, tag_index_changed, \
+    page_of, TagQueryError
+from limits import init_limits
+from profiler import init_profiler
+from home_feed import home_page, parse_cursor, refresh_feed_entry, \
+    refresh_author_name, refresh_tag_names, remove_feed_entries
 from sqlalchemy import desc
+from sqlalchemy.orm import joinedload, selectinload
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///blogly"
+app.config["SQLALCHEMY_DATABASE_URI"] = \
+    os.environ.get("DATABASE_URL", "postgresql:///blogly")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = True
 app.config["SECRET_KEY"] = "kubrick"
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+# tag: URI authority for the ids in Atom feeds, which must never change
+app.config["FEED_TAG_AUTHORITY"] = \
+    os.environ.get("FEED_TAG_AUTHORITY", "blogly,2020")
+# proxies in front of the app, whose X-Forwarded-For rate limits go by
+app.config["RATELIMIT_PROXIES"] = int(os.environ.get("RATELIMIT_PROXIES", 0))
 
 connect_db(app)
-db.create_all()
+# only an empty db is created here, any other is changed by "flask migrate"
+bootstrap()
+init_limits(app)
+init_profiler(app)
+
+# related posts and the tag index are built on first use, since they check a
+# table that "flask migrate" adds
+related_posts.start_refresher()
+
+def stream_template(template_name, **context):
+    """
+        Renders template_name a few pieces at a time as the response is sent,
+        instead of building the whole page in memory first
+        type template_name: str
+        rtype: Response
+    """
+    # the session cookie is sent before the page is rendered, so flashed
+    # messages have to be taken out of it now
+    get_flashed_messages()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(5)
+    return Response(stream_with_context(stream))
+
+@app.cli.command("migrate")
+def migrate():
+    """
+        Applies any migrations that haven't been run on the db yet
+    """
+    ran = upgrade()
+    for migration_id in ran:
+        print(f"Applied {migration_id}")
+    if not ran:
+        print("Already up to date")
+
+@app.cli.command("check-fk-indexes")
+def check_fk_indexes():
+    """
+        Lists foreign keys that have no index, exiting with an error if any
+        are found
+    """
+    unindexed = find_unindexed_foreign_keys()
+    for table, columns, referred_table in unindexed:
+        print(f"{table}({', '.join(columns)}) -> {referred_table} has no index")
+    if unindexed:
+        raise SystemExit(1)
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -26,11 +91,15 @@ def page_not_found(e):
 @app.route("/")
 def show_home_page():
     """
-        Shows the home page with a list of 5 most recent posts
+        Shows a page of the home page's list of the most recent posts
         rtype: str
     """
-    posts = Post.query.order_by(desc(Post.created_at)).all()
-    return render_template("home.html", posts=posts)
+    before = parse_cursor(request.args.get("before", ""))
+    after = parse_cursor(request.args.get("after", ""))
+    entries, older, newer = home_page(before, after)
+
+    return render_template("home.html", entries=entries, older=older, \
+        newer=newer)
 
 @app.route("/users")
 def show_user_list():
@@ -129,7 +198,10 @@ def edit_user(user_id):
     user.last_name = last_name
     user.image_url = image_url
     db.session.add(user)
+    refresh_author_name(user)
     db.session.commit()
+    # the user's name is shown on their posts in every feed
+    feed_cache.clear()
 
     flash("User has been successfully updated", "success")
     return redirect("/users")
@@ -142,8 +214,17 @@ def delete_user(user_id):
         rtype: str
     """
     user = User.query.get_or_404(user_id)
+    post_ids = [post.id for post in user.posts]
+    remove_feed_entries(post_ids)
     db.session.delete(user)
     db.session.commit()
+    feed_cache.clear()
+
+    for post_id in post_ids:
+        related_posts.remove(post_id)
+        tag_index.remove_post(post_id)
+    related_posts_changed()
+    tag_index_changed()
 
     return redirect("/users")
 
@@ -188,13 +269,20 @@ def add_post(user_id):
     # create post and add to db
     post = Post(title=title, content=content, user_id=user_id)
     db.session.add(post)
-    db.session.commit()
+    db.session.flush()
 
     # add tags to post
     for tag_id in tag_ids_selected:
         post_tag = PostTag(post_id=post.id, tag_id=tag_id)
         db.session.add(post_tag)
+    refresh_feed_entry(post)
     db.session.commit()
+    feed_cache.invalidate(feed_keys(user_id, tag_ids_selected))
+
+    related_posts.update(post.id, tag_ids_selected)
+    tag_index.set_post(post.id, tag_ids_selected)
+    related_posts_changed()
+    tag_index_changed()
 
     flash("Post has been successfully created", "success")
     return redirect(f"/users/{user_id}")
@@ -208,10 +296,23 @@ def show_post_details(post_id):
         type post_id: int
         rtype: str
     """
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(joinedload(Post.user), \
+        selectinload(Post.tags)).filter_by(id=post_id).first_or_404()
     tags = post.tags
 
-    return render_template("post-details.html", post=post, tags=tags)
+    # keep the order of the related posts, most related first
+    sync_related_posts()
+    related_ids = related_posts.get(post_id)
+    related = Post.query.filter(Post.id.in_(related_ids)).all() \
+        if related_ids else []
+    related.sort(key=lambda related_post: related_ids.index(related_post.id))
+
+    # everything else on the page is loaded by now, so the connection is
+    # handed back before the page is sent, and the content is loaded a few
+    # chunks at a time while it is
+    db.session.close()
+    return stream_template("post-details.html", post=post, tags=tags, \
+        related=related)
 
 @app.route("/posts/<int:post_id>/edit")
 def show_post_edit_form(post_id):
@@ -245,10 +346,11 @@ def edit_post(post_id):
 
     # edit post
     post = Post.query.get(post_id)
+    old_tag_ids = [tag.id for tag in post.tags]
     post.title = title
     post.content = content
     db.session.add(post)
-    db.session.commit()
+    db.session.flush()
 
     # update tags for post
     tags = Tag.query.all()
@@ -274,7 +376,18 @@ def edit_post(post_id):
             if tag_removed:
                 post_tag = PostTag.query.filter_by(post_id=post.id, tag_id=tag.id).one()
                 db.session.delete(post_tag)
+    refresh_feed_entry(post)
+    checked_tag_ids = \
+        [tag.id for tag in tags if request.form.get(tag.name, None)]
+    keys = feed_keys(post.user_id, set(old_tag_ids + checked_tag_ids))
     db.session.commit()
+    feed_cache.invalidate(keys)
+
+    new_tag_ids = [tag.id for tag in post.tags]
+    related_posts.update(post.id, new_tag_ids)
+    tag_index.set_post(post.id, new_tag_ids)
+    related_posts_changed()
+    tag_index_changed()
 
     flash("Post has been successfully updated", "success")
     return redirect(f"/posts/{post_id}")
@@ -289,11 +402,46 @@ def delete_post(post_id):
     # first determine which user created the post, to go to the user's page
     user = Post.query.get_or_404(post_id).user
     post = Post.query.filter_by(id=post_id).one()
+    tag_ids = [tag.id for tag in post.tags]
+    remove_feed_entries([post_id])
     db.session.delete(post)
+    keys = feed_keys(user.id, tag_ids)
     db.session.commit()
+    feed_cache.invalidate(keys)
+
+    related_posts.remove(post_id)
+    tag_index.remove_post(post_id)
+    related_posts_changed()
+    tag_index_changed()
 
     return redirect(f"/users/{user.id}")
 
+@app.route("/posts")
+def show_filtered_posts():
+    """
+        Shows a page of the posts matching the tag query in the tags query
+        string parameter, such as "funny,profound,-work" for posts tagged
+        funny and profound but not work
+        rtype: str
+    """
+    query = request.args.get("tags", "")
+    page = max(1, request.args.get("page", 1, type=int))
+
+    sync_tag_index()
+    try:
+        matches = tag_index.query(query)
+    except TagQueryError as error:
+        flash(str(error), "danger")
+        matches = []
+
+    # keep the order of the page, newest first
+    post_ids, num_of_pages = page_of(matches, page)
+    posts = Post.query.filter(Post.id.in_(post_ids)).all() if post_ids else []
+    posts.sort(key=lambda post: post_ids.index(post.id))
+
+    return render_template("posts.html", posts=posts, query=query, \
+        page=page, num_of_pages=num_of_pages, num_of_posts=len(matches))
+
 @app.route("/tags")
 def show_tag_list():
     """
@@ -317,7 +465,16 @@ def show_tag(tag_id):
     tag = Tag.query.get_or_404(tag_id)
     posts = tag.posts
 
-    return render_template("tag-details.html", tag=tag, posts=posts)
+    # keep the order of the related tags, most often together first
+    sync_related_posts()
+    related_tag_ids = related_posts.related_tags(tag_id)
+    related_tags = Tag.query.filter(Tag.id.in_(related_tag_ids)).all() \
+        if related_tag_ids else []
+    related_tags.sort(key=lambda related_tag: \
+        related_tag_ids.index(related_tag.id))
+
+    return render_template("tag-details.html", tag=tag, posts=posts, \
+        related_tags=related_tags)
 
 @app.route("/tags/new")
 def show_add_tag_form():
@@ -345,6 +502,9 @@ def add_tag():
     db.session.add(new_tag)
     db.session.commit()
 
+    tag_index.set_tag(new_tag.id, name)
+    tag_index_changed()
+
     flash("The tag has been successfully created", "success")
     return redirect("/tags")
 
@@ -378,7 +538,13 @@ def edit_tag(tag_id):
     tag = Tag.query.get_or_404(tag_id)
     tag.name = name
     db.session.add(tag)
+    refresh_tag_names([post.id for post in tag.posts])
     db.session.commit()
+    # the tag's name is shown on its posts in every feed
+    feed_cache.clear()
+
+    tag_index.set_tag(tag.id, name)
+    tag_index_changed()
 
     flash("The tag has been successfully edited", "success")
     return redirect("/tags")
@@ -391,7 +557,92 @@ def delete_tag(tag_id):
         rtype: str
     """
     tag = Tag.query.get_or_404(tag_id)
+    post_ids = [post.id for post in tag.posts]
     db.session.delete(tag)
+    refresh_tag_names(post_ids)
     db.session.commit()
+    feed_cache.clear()
+
+    related_posts.remove_tag(tag_id)
+    tag_index.remove_tag(tag_id)
+    related_posts_changed()
+    tag_index_changed()
+
+    return redirect("/tags")
+
+def serve_feed(key, site_path, build):
+    """
+        Serves the Atom feed with key, answering conditional requests from the
+        cache. The feed is only rendered when it has changed since it was last
+        requested, in which case build() is called to get the feed's title and
+        a query for its posts.
+        type key: str
+        type site_path: str
+        type build: function
+        rtype: Response
+    """
+    etag = feed_cache.etag(key)
+    cached = feed_cache.get(key, etag)
+
+    if cached:
+        body, last_modified = cached
+        resp = Response(body, mimetype=ATOM_MIMETYPE)
+    else:
+        title, query = build()
+        posts = query.options(joinedload(Post.user), selectinload(Post.tags)) \
+            .order_by(desc(Post.created_at)).limit(FEED_SIZE).all()
+        last_modified = datetime.utcnow()
+        site_url = request.url_root + site_path.lstrip("/")
+        chunks = write_feed(title, app.config["FEED_TAG_AUTHORITY"], key, \
+            request.base_url, site_url, request.url_root, posts)
+
+        def generate():
+            rendered = []
+            for chunk in chunks:
+                rendered.append(chunk)
+                yield chunk
+            feed_cache.set(key, etag, "".join(rendered), last_modified)
+
+        resp = Response(stream_with_context(generate()), \
+            mimetype=ATOM_MIMETYPE)
+
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+@app.route("/feed.xml")
+def show_feed():
+    """
+        Shows an Atom feed of the most recent posts
+        rtype: Response
+    """
+    return serve_feed("all", "/", lambda: ("Blogly Recent Posts", Post.query))
+
+@app.route("/tags/<int:tag_id>/feed.xml")
+def show_tag_feed(tag_id):
+    """
+        Shows an Atom feed of the most recent posts with tag with id tag_id
+        type tag_id: int
+        rtype: Response
+    """
+    def build():
+        tag = Tag.query.get_or_404(tag_id)
+        query = Post.query.join(PostTag).filter(PostTag.tag_id == tag_id)
+        return f"Blogly Posts Tagged {tag.name}", query
+
+    return serve_feed(f"tag-{tag_id}", f"/tags/{tag_id}", build)
+
+@app.route("/users/<int:user_id>/feed.xml")
+def show_user_feed(user_id):
+    """
+        Shows an Atom feed of the most recent posts by user with id user_id
+        type user_id: int
+        rtype: Response
+    """
+    def build():
+        user = User.query.get_or_404(user_id)
+        query = Post.query.filter_by(user_id=user_id)
+        return f"Blogly Posts By {user.full_name}", query
 
-    return redirect("/tags")
\ No newline at end of file
+    return serve_feed(f"user-{user_id}", f"/users/{user_id}", build)
@@ -0,0 +1,83 @@
+"""Timing reports for the Blogly tests."""
+
+import json
+
+def pytest_addoption(parser):
+    parser.addoption("--slowest", type=int, default=10, \
+        help="number of slowest tests to list after the run")
+    parser.addoption("--max-test-seconds", type=float, default=None, \
+        help="fail the run if any test takes longer than this")
+    parser.addoption("--timings-json", default=None, \
+        help="file to write every test's setup, call and teardown times to")
+
+def pytest_configure(config):
+    # with pytest-xdist, only the controller reports, since every worker's
+    # results are passed on to it
+    if not hasattr(config, "workerinput"):
+        config.pluginmanager.register(TimingReport(config), "timing-report")
+
+class TimingReport:
+    """
+        Records how long each test takes, then lists the slowest tests, flags
+        tests over --max-test-seconds (failing the run), and writes every
+        test's times to --timings-json.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.timings = {}
+        self.too_slow = []
+
+    def totals(self):
+        """
+            Gets the total time for each test
+            rtype: dict
+        """
+        return {nodeid: sum(phases.values()) \
+            for nodeid, phases in self.timings.items()}
+
+    def pytest_runtest_logreport(self, report):
+        self.timings.setdefault(report.nodeid, {})[report.when] = \
+            report.duration
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        max_seconds = self.config.getoption("max_test_seconds")
+        if max_seconds is None:
+            return
+        totals = self.totals()
+        self.too_slow = sorted(
+            [nodeid for nodeid in totals if totals[nodeid] > max_seconds],
+            key=totals.get, reverse=True
+        )
+        if self.too_slow and exitstatus == 0:
+            session.exitstatus = 1
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.timings:
+            return
+        totals = self.totals()
+        slowest = sorted(totals, key=totals.get, reverse=True)
+
+        terminalreporter.section("test timings")
+        terminalreporter.write_line(
+            f"{len(totals)} tests took {sum(totals.values()):.2f}s in total"
+        )
+        for nodeid in slowest[:self.config.getoption("slowest")]:
+            phases = self.timings[nodeid]
+            terminalreporter.write_line(
+                f"{totals[nodeid]:.3f}s {nodeid} "
+                f"(setup {phases.get('setup', 0):.3f}s, "
+                f"call {phases.get('call', 0):.3f}s, "
+                f"teardown {phases.get('teardown', 0):.3f}s)"
+            )
+
+        max_seconds = self.config.getoption("max_test_seconds")
+        for nodeid in self.too_slow:
+            terminalreporter.write_line(
+                f"over {max_seconds}s: {nodeid} ({totals[nodeid]:.3f}s)", \
+                red=True
+            )
+
+        path = self.config.getoption("timings_json")
+        if path:
+            with open(path, "w") as timings_file:
+                json.dump(self.timings, timings_file, indent=2, sort_keys=True)
@@ -0,0 +1,210 @@
+"""Atom feeds for Blogly."""
+
+import io
+from datetime import datetime
+from threading import Lock
+from xml.sax.saxutils import XMLGenerator
+from sqlalchemy import text
+from models import db, FeedVersion
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+ATOM_MIMETYPE = "application/atom+xml"
+
+# number of posts in each feed
+FEED_SIZE = 20
+
+# version bumped to invalidate every feed at once
+ALL_FEEDS = "*"
+
+class FeedCache:
+    """
+        Keeps rendered feeds in memory until a write changes them. Each feed
+        has a version in the feed_versions table that is bumped in a short
+        transaction of its own once the write is committed, and the versions
+        are used as the feed's ETag. Every process checks the versions before serving a cached feed,
+        so a write in one process is seen by all of them, and polling clients
+        are answered without rendering anything.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.feeds = {}
+
+    def etag(self, key):
+        """
+            Gets the ETag for the current version of feed key
+            type key: str
+            rtype: str
+        """
+        versions = dict(db.session.query(FeedVersion.name, FeedVersion.version)
+            .filter(FeedVersion.name.in_([ALL_FEEDS, key])))
+        return f"{versions.get(ALL_FEEDS, 0)}-{versions.get(key, 0)}"
+
+    def get(self, key, etag):
+        """
+            Gets the rendered body of feed key and when it was rendered, or
+            None if the version with etag isn't cached
+            type key: str
+            type etag: str
+            rtype: tuple(str, datetime) or None
+        """
+        with self.lock:
+            cached = self.feeds.get(key)
+        if cached and cached[0] == etag:
+            return cached[1:]
+        return None
+
+    def set(self, key, etag, body, last_modified):
+        """
+            Caches the rendered body of the version of feed key with etag
+            type key: str
+            type etag: str
+            type body: str
+            type last_modified: datetime
+        """
+        with self.lock:
+            self.feeds[key] = (etag, body, last_modified)
+
+    def invalidate(self, keys):
+        """
+            Bumps the versions of the feeds in keys, so they're rendered again
+            on next request. Call it once the write that changed the feeds is
+            committed: the versions are committed on their own, so writes
+            don't queue on the lock of a busy feed's row (like ALL_FEEDS) for
+            the whole of their transaction, and a feed rendered in between is
+            still thrown away.
+            type keys: list[str]
+        """
+        # in a fixed order, so two bumps can't deadlock on each other's rows
+        for key in sorted(keys):
+            db.session.execute(text(
+                "INSERT INTO feed_versions (name, version) VALUES (:name, 1) "
+                "ON CONFLICT (name) DO UPDATE "
+                "SET version = feed_versions.version + 1"
+            ), {"name": key})
+        db.session.commit()
+        with self.lock:
+            for key in keys:
+                self.feeds.pop(key, None)
+
+    def clear(self):
+        """
+            Invalidates every feed, for writes that show up in all of them
+            (like renaming a user or a tag)
+        """
+        self.invalidate([ALL_FEEDS])
+        self.reset()
+
+    def reset(self):
+        """
+            Forgets every rendered feed, for when the versions they were
+            rendered for may be handed out again (like after a rollback)
+        """
+        with self.lock:
+            self.feeds = {}
+
+feed_cache = FeedCache()
+
+def feed_keys(user_id, tag_ids):
+    """
+        Gets the keys of the feeds a post by user_id with tags tag_ids shows
+        up in
+        type user_id: int
+        type tag_ids: iterable[int]
+        rtype: list[str]
+    """
+    return ["all", f"user-{user_id}"] + [f"tag-{tag_id}" for tag_id in tag_ids]
+
+def tag_uri(authority, path):
+    """
+        Makes a tag: URI (RFC 4151) for path, to use as a stable Atom id that
+        doesn't depend on the host the feed was requested from
+        type authority: str
+        type path: str
+        rtype: str
+    """
+    return f"tag:{authority}:{path}"
+
+def atom_date(date):
+    """
+        Formats date, which is in UTC, the way Atom expects it
+        type date: datetime
+        rtype: str
+    """
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def text_element(xml, name, text, attrs=None):
+    """
+        Writes element name containing text
+        type xml: XMLGenerator
+        type name: str
+        type text: str
+        type attrs: dict
+    """
+    xml.startElement(name, attrs or {})
+    xml.characters(text)
+    xml.endElement(name)
+
+def empty_element(xml, name, attrs):
+    """
+        Writes element name with only attributes
+        type xml: XMLGenerator
+        type name: str
+        type attrs: dict
+    """
+    xml.startElement(name, attrs)
+    xml.endElement(name)
+
+def write_feed(title, authority, key, feed_url, site_url, root_url, posts):
+    """
+        Writes an Atom feed of posts, with each post's stored excerpt as its
+        summary, yielding the XML one entry at a time so the whole document is
+        never built up in memory at once. The feed and its entries get tag:
+        URIs under authority as their ids, the feed's made from its key.
+        type title: str
+        type authority: str
+        type key: str
+        type feed_url: str
+        type site_url: str
+        type root_url: str
+        type posts: list[Post]
+        rtype: iterator[str]
+    """
+    buffer = io.StringIO()
+    xml = XMLGenerator(buffer, encoding="utf-8", short_empty_elements=True)
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    xml.startDocument()
+    xml.startElement("feed", {"xmlns": ATOM_NS})
+    text_element(xml, "title", title)
+    text_element(xml, "id", tag_uri(authority, f"feeds/{key}"))
+    empty_element(xml, "link", {"rel": "self", "href": feed_url})
+    empty_element(xml, "link", {"rel": "alternate", "href": site_url})
+    updated = posts[0].created_at if posts else datetime.utcnow()
+    text_element(xml, "updated", atom_date(updated))
+    yield flush()
+
+    for post in posts:
+        post_url = f"{root_url}posts/{post.id}"
+        xml.startElement("entry", {})
+        text_element(xml, "title", post.title)
+        text_element(xml, "id", tag_uri(authority, f"posts/{post.id}"))
+        empty_element(xml, "link", {"rel": "alternate", "href": post_url})
+        text_element(xml, "updated", atom_date(post.created_at))
+        xml.startElement("author", {})
+        text_element(xml, "name", post.user.full_name)
+        xml.endElement("author")
+        for tag in post.tags:
+            empty_element(xml, "category", {"term": tag.name})
+        text_element(xml, "summary", post.excerpt, {"type": "text"})
+        xml.endElement("entry")
+        yield flush()
+
+    xml.endElement("feed")
+    xml.endDocument()
+    yield flush()
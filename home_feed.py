@@ -0,0 +1,182 @@
+"""Home page feed for Blogly."""
+
+from datetime import datetime
+from sqlalchemy import tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import joinedload, load_only
+from models import db, Post, Tag, PostTag, FeedEntry
+
+# number of posts on each page of the home page
+HOME_PAGE_SIZE = 10
+
+def tag_names_by_post(post_ids):
+    """
+        Gets the names of the tags on each of post_ids, in alphabetical order
+        type post_ids: list[int]
+        rtype: dict
+    """
+    names = {post_id: [] for post_id in post_ids}
+    rows = db.session.query(PostTag.post_id, Tag.name).join(Tag) \
+        .filter(PostTag.post_id.in_(post_ids)).order_by(Tag.name)
+    for post_id, name in rows:
+        names[post_id].append(name)
+    return names
+
+def make_feed_entry(post, tag_names, entry=None):
+    """
+        Fills in entry (or a new entry) for post with tag_names
+        type post: Post
+        type tag_names: list[str]
+        type entry: FeedEntry
+        rtype: FeedEntry
+    """
+    entry = entry or FeedEntry(post_id=post.id)
+    entry.user_id = post.user_id
+    entry.created_at = post.created_at
+    entry.title = post.title
+    entry.excerpt = post.excerpt
+    entry.author_name = post.user.full_name
+    entry.friendly_date = post.friendly_date
+    entry.tag_names = tag_names
+    return entry
+
+def refresh_feed_entry(post):
+    """
+        Adds or updates the feed entry for post, which must have been flushed
+        along with its tags. Doesn't commit, so the entry is saved in the
+        same transaction as the change to the post.
+        type post: Post
+    """
+    db.session.flush()
+    entry = FeedEntry.query.get(post.id)
+    tag_names = tag_names_by_post([post.id])[post.id]
+    db.session.add(make_feed_entry(post, tag_names, entry))
+
+def refresh_author_name(user):
+    """
+        Updates the author's name on the feed entries for user's posts
+        type user: User
+    """
+    FeedEntry.query.filter_by(user_id=user.id) \
+        .update({"author_name": user.full_name}, synchronize_session=False)
+
+def refresh_tag_names(post_ids):
+    """
+        Updates the tag names on the feed entries for post_ids, after a tag on
+        them was renamed or deleted
+        type post_ids: list[int]
+    """
+    if not post_ids:
+        return
+    db.session.flush()
+    names = tag_names_by_post(post_ids)
+    for entry in FeedEntry.query.filter(FeedEntry.post_id.in_(post_ids)):
+        entry.tag_names = names[entry.post_id]
+
+def remove_feed_entries(post_ids):
+    """
+        Removes the feed entries for post_ids, which are being deleted
+        type post_ids: list[int]
+    """
+    if post_ids:
+        FeedEntry.query.filter(FeedEntry.post_id.in_(post_ids)) \
+            .delete(synchronize_session=False)
+
+def insert_feed_entries(entries):
+    """
+        Inserts entries, skipping any whose post already has an entry, like
+        one added by a view since the entries were made
+        type entries: list[FeedEntry]
+    """
+    table = FeedEntry.__table__
+    if db.engine.dialect.name == "postgresql":
+        insert = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        insert = table.insert().prefix_with("OR IGNORE")
+    db.session.execute(insert, [
+        {column.name: getattr(entry, column.name) for column in table.columns}
+        for entry in entries
+    ])
+
+def build_feed_entries(batch_size=500):
+    """
+        Adds the missing feed entries from the posts, users and tags tables,
+        committing after each batch of posts. Entries that already exist are
+        kept, so the home page stays whole while this runs on a live db.
+        type batch_size: int
+    """
+    last_id = 0
+    while True:
+        posts = Post.query.options(joinedload(Post.user)) \
+            .outerjoin(FeedEntry, FeedEntry.post_id == Post.id) \
+            .filter(Post.id > last_id, FeedEntry.post_id.is_(None)) \
+            .order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            break
+        names = tag_names_by_post([post.id for post in posts])
+        insert_feed_entries([make_feed_entry(post, names[post.id]) \
+            for post in posts])
+        db.session.commit()
+        last_id = posts[-1].id
+
+def make_cursor(entry):
+    """
+        Gets the cursor for the place of entry in the home page's order, for
+        the links to the pages before and after it
+        type entry: FeedEntry
+        rtype: str
+    """
+    return f"{entry.created_at.isoformat()}_{entry.post_id}"
+
+def parse_cursor(cursor):
+    """
+        Gets the (created_at, post_id) a cursor made by make_cursor() stands
+        for, or None if it isn't one
+        type cursor: str
+        rtype: tuple(datetime, int) or None
+    """
+    created_at, _, post_id = cursor.rpartition("_")
+    try:
+        return datetime.fromisoformat(created_at), int(post_id)
+    except ValueError:
+        return None
+
+def home_page(before=None, after=None):
+    """
+        Gets a page of feed entries for the home page, newest first: the
+        entries just older than the (created_at, post_id) before, or just
+        newer than after, or else the newest ones. Also gets the cursors for
+        the pages of older and of newer entries, which are None when there
+        are none. Only reads the columns shown from the feed_entries table,
+        starting at the cursor in its index on (created_at, post_id), so a
+        page deep in the list costs as little as the first.
+        type before: tuple(datetime, int)
+        type after: tuple(datetime, int)
+        rtype: tuple(list[FeedEntry], str, str)
+    """
+    key = tuple_(FeedEntry.created_at, FeedEntry.post_id)
+    query = FeedEntry.query.options(load_only("created_at", "title", \
+        "excerpt", "author_name", "friendly_date", "tag_names"))
+
+    if after is not None:
+        entries = query.filter(key > tuple_(*after)) \
+            .order_by(FeedEntry.created_at, FeedEntry.post_id) \
+            .limit(HOME_PAGE_SIZE + 1).all()
+        has_newer = len(entries) > HOME_PAGE_SIZE
+        has_older = True
+        entries = entries[:HOME_PAGE_SIZE][::-1]
+    else:
+        if before is not None:
+            query = query.filter(key < tuple_(*before))
+        entries = query \
+            .order_by(FeedEntry.created_at.desc(), FeedEntry.post_id.desc()) \
+            .limit(HOME_PAGE_SIZE + 1).all()
+        has_newer = before is not None
+        has_older = len(entries) > HOME_PAGE_SIZE
+        entries = entries[:HOME_PAGE_SIZE]
+
+    if not entries:
+        return entries, None, None
+    older = make_cursor(entries[-1]) if has_older else None
+    newer = make_cursor(entries[0]) if has_newer else None
+    return entries, older, newer
@@ -0,0 +1,242 @@
+"""Rate limiting and load shedding for Blogly."""
+
+import math
+import time
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock
+from flask import current_app, g, request, Response
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# the least recently used buckets are forgotten beyond this many
+MEMORY_MAX_BUCKETS = 10000
+
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+def take_token(tokens, updated, rate, capacity, now):
+    """
+        Refills a token bucket that had tokens left at time updated, then
+        takes a token from it if there is one. This is the same algorithm as
+        TOKEN_BUCKET_SCRIPT. Returns whether a token was taken, the seconds
+        until one will be available if not, and the tokens left.
+        type tokens: float
+        type updated: float
+        type rate: float
+        type capacity: int
+        type now: float
+        rtype: tuple(bool, float, float)
+    """
+    tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens >= 1:
+        return True, 0, tokens - 1
+    return False, (1 - tokens) / rate, tokens
+
+class MemoryBackend:
+    """
+        Keeps token buckets in this process's memory, forgetting the least
+        recently used once there are more than max_buckets. A forgotten bucket
+        is treated as full. Each process limits on its own, so with several
+        processes use SharedBackend instead.
+    """
+    def __init__(self, max_buckets=MEMORY_MAX_BUCKETS):
+        self.lock = Lock()
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+
+    def hit(self, key, rate, capacity):
+        """
+            Takes a token from bucket key, which holds up to capacity tokens
+            and gets rate tokens per second. Returns whether a token was taken
+            and the seconds until one will be available if not.
+            type key: str
+            type rate: float
+            type capacity: int
+            rtype: tuple(bool, float)
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            allowed, retry_after, tokens = \
+                take_token(tokens, updated, rate, capacity, now)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return allowed, retry_after
+
+class SharedBackend:
+    """
+        Keeps token buckets in Redis, so every process shares the same limits.
+        Each hit runs TOKEN_BUCKET_SCRIPT, which Redis runs atomically.
+    """
+    def __init__(self, client, prefix="blogly:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    def hit(self, key, rate, capacity):
+        """
+            Takes a token from bucket key (see MemoryBackend.hit())
+            type key: str
+            type rate: float
+            type capacity: int
+            rtype: tuple(bool, float)
+        """
+        allowed, retry_after = self.client.eval(TOKEN_BUCKET_SCRIPT, 1, \
+            self.prefix + key, rate, capacity, time.time())
+        return bool(int(allowed)), float(retry_after)
+
+class FakeRedis:
+    """
+        Stands in for a Redis server in tests and local development, for use
+        with SharedBackend. Only supports running TOKEN_BUCKET_SCRIPT, which
+        it does with take_token().
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.hashes = {}
+
+    def eval(self, script, numkeys, key, rate, capacity, now):
+        """
+            Runs TOKEN_BUCKET_SCRIPT on key
+            type script: str
+            type numkeys: int
+            type key: str
+            type rate: float
+            type capacity: int
+            type now: float
+            rtype: list
+        """
+        if script != TOKEN_BUCKET_SCRIPT:
+            raise ValueError("FakeRedis only runs the bucket script")
+        with self.lock:
+            tokens, updated = self.hashes.get(key, (capacity, now))
+            allowed, retry_after, tokens = \
+                take_token(tokens, updated, rate, capacity, now)
+            self.hashes[key] = (tokens, now)
+        return [int(allowed), str(retry_after)]
+
+def make_backend(url):
+    """
+        Makes the backend for storage url, which is either memory://, fake://
+        for a SharedBackend using FakeRedis, or the url of a Redis server
+        (which needs the redis package)
+        type url: str
+        rtype: MemoryBackend or SharedBackend
+    """
+    if url == "memory://":
+        return MemoryBackend()
+    if url == "fake://":
+        return SharedBackend(FakeRedis())
+
+    # redis is only needed when limits are shared between processes
+    import redis
+    return SharedBackend(redis.Redis.from_url(url))
+
+def client_address():
+    """
+        Identifies the client a request is from by its address. Behind a
+        proxy that is the proxy's address for every client, unless
+        RATELIMIT_PROXIES says how many proxies to read X-Forwarded-For from.
+        rtype: str
+    """
+    return request.remote_addr
+
+def too_many_requests(retry_after):
+    """
+        Makes the response for a client that has run out of tokens
+        type retry_after: float
+        rtype: Response
+    """
+    return Response("Too many requests, please slow down", status=429, \
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+def service_unavailable():
+    """
+        Makes the response for a request shed because the server is busy
+        rtype: Response
+    """
+    retry_after = current_app.config["ADMISSION_RETRY_AFTER"]
+    return Response("The server is busy, please try again shortly", \
+        status=503, headers={"Retry-After": str(retry_after)})
+
+def init_limits(app):
+    """
+        Limits each client to RATELIMIT_WRITE (rate per second, burst) on each
+        POST route and RATELIMIT_READ on every other route, and sheds requests
+        with a 503 when more than MAX_CONCURRENT_REQUESTS are already being
+        handled, before they can wait on the db connection pool. Clients are
+        told apart by RATELIMIT_KEY_FUNC, which is client_address() unless
+        set. When the app is behind RATELIMIT_PROXIES proxies, the client's
+        address is taken from the X-Forwarded-For they set.
+        type app: Flask
+    """
+    app.config.setdefault("RATELIMIT_ENABLED", True)
+    app.config.setdefault("RATELIMIT_KEY_FUNC", client_address)
+    app.config.setdefault("RATELIMIT_PROXIES", 0)
+    app.config.setdefault("RATELIMIT_STORAGE_URL", "memory://")
+    app.config.setdefault("RATELIMIT_READ", (5.0, 30))
+    app.config.setdefault("RATELIMIT_WRITE", (0.5, 10))
+    # the default db pool is 5 connections plus 10 overflow
+    app.config.setdefault("MAX_CONCURRENT_REQUESTS", 12)
+    app.config.setdefault("ADMISSION_TIMEOUT", 0.5)
+    app.config.setdefault("ADMISSION_RETRY_AFTER", 1)
+
+    if app.config["RATELIMIT_PROXIES"]:
+        # only trust as many forwarded addresses as there are proxies, since
+        # clients can send X-Forwarded-For themselves
+        app.wsgi_app = ProxyFix(app.wsgi_app, \
+            x_for=app.config["RATELIMIT_PROXIES"])
+
+    backend = make_backend(app.config["RATELIMIT_STORAGE_URL"])
+    slots = BoundedSemaphore(app.config["MAX_CONCURRENT_REQUESTS"])
+
+    @app.before_request
+    def admit_request():
+        """
+            Rejects the request if the client is over its rate limit or the
+            server is too busy to handle it
+        """
+        config = current_app.config
+        if request.endpoint == "static":
+            return None
+
+        if config["RATELIMIT_ENABLED"]:
+            if request.method == "POST":
+                rate, capacity = config["RATELIMIT_WRITE"]
+            else:
+                rate, capacity = config["RATELIMIT_READ"]
+            client = config["RATELIMIT_KEY_FUNC"]()
+            key = f"{client}:{request.method}:{request.endpoint}"
+            allowed, retry_after = backend.hit(key, rate, capacity)
+            if not allowed:
+                return too_many_requests(retry_after)
+
+        if not slots.acquire(timeout=config["ADMISSION_TIMEOUT"]):
+            return service_unavailable()
+        g.admitted = True
+        return None
+
+    @app.teardown_request
+    def release_request(exc):
+        """
+            Frees the request's slot once it has been handled
+        """
+        if g.pop("admitted", False):
+            slots.release()
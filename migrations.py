@@ -0,0 +1,533 @@
+"""Schema migrations for Blogly."""
+
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import bindparam, inspect, text
+from models import db
+
+# key of the Postgres advisory lock held while the schema is being changed
+MIGRATION_LOCK_ID = 0x626c6f67
+
+# migrations spell out their own schema and SQL instead of using the models,
+# so they keep doing what they did when they were written as the models
+# change. This is how make_excerpt() made excerpts for 0003_post_excerpts.
+EXCERPT_LENGTH = 200
+EXCERPT_WHITESPACE = " \t\n\r\f\v"
+
+schema_migrations = db.Table(
+    "schema_migrations",
+    db.Column("id", db.Text, primary_key=True),
+    db.Column("applied_at", db.DateTime, nullable=False, \
+        default=datetime.utcnow)
+)
+
+# how far a migration that updates rows in batches has got, so a run that was
+# stopped part way through picks up where it left off
+migration_progress = db.Table(
+    "migration_progress",
+    db.Column("id", db.Text, primary_key=True),
+    db.Column("max_id", db.Integer, nullable=False),
+    db.Column("last_id", db.Integer, nullable=False)
+)
+
+# how many characters of content were put in each chunk by 0006_post_chunks
+POST_CHUNK_SIZE = 8192
+
+# how Post.friendly_date showed dates when 0003_post_excerpts and
+# 0005_utc_post_dates were written
+FRIENDLY_DATE_FORMAT = "%a %b %#d %Y, %#I:%M %p"
+
+def is_postgres():
+    """
+        Checks whether the db is Postgres, since some operations (like
+        building indexes concurrently) are only available there
+        rtype: bool
+    """
+    return db.engine.dialect.name == "postgresql"
+
+def autocommit_connection():
+    """
+        Gets a connection that commits each statement on its own. Postgres
+        refuses to run CREATE/DROP INDEX CONCURRENTLY inside a transaction.
+        rtype: Connection
+    """
+    return db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+def create_index_concurrently(name, table, columns):
+    """
+        Creates index name on columns of table without locking out writes to
+        the table. If a previous concurrent build failed part way through, the
+        invalid index it left behind is dropped and the index is rebuilt.
+        type name: str
+        type table: str
+        type columns: list[str]
+    """
+    column_list = ", ".join(columns)
+
+    if not is_postgres():
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column_list})"
+            ))
+        return
+
+    conn = autocommit_connection()
+    try:
+        # a failed concurrent build leaves an invalid index that is never used
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), name=name).first()
+        if invalid:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+        conn.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+            f"ON {table} ({column_list})"
+        ))
+    finally:
+        conn.close()
+
+def add_column(table, column, column_type):
+    """
+        Adds a nullable column to table if it doesn't exist yet. Nullable
+        columns without a default are added without rewriting the table, so
+        existing rows should be filled in afterwards with backfill_column().
+        type table: str
+        type column: str
+        type column_type: str
+    """
+    existing = [col["name"] for col in inspect(db.engine).get_columns(table)]
+    if column in existing:
+        return
+
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+        ))
+
+def update_in_batches(table, assignment, condition, batch_size=1000, \
+    pause=0.1, last_id=0, params=None, on_batch=None):
+    """
+        Runs UPDATE table SET assignment on every row matching condition with
+        an id above last_id, batch_size rows at a time in id order. Each batch
+        is committed on its own and is followed by a pause, so row locks are
+        held briefly and the load on the db stays throttled. params are bound
+        in assignment and condition, and on_batch(conn, low, high) is called
+        in each batch's transaction after its update. Returns the number of
+        rows updated.
+        type table: str
+        type assignment: str
+        type condition: str
+        type batch_size: int
+        type pause: float
+        type last_id: int
+        type params: dict
+        type on_batch: function
+        rtype: int
+    """
+    params = params or {}
+    updated = 0
+
+    while True:
+        with db.engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(text(
+                f"SELECT id FROM {table} WHERE id > :last_id "
+                f"AND {condition} ORDER BY id LIMIT :batch_size"
+            ), last_id=last_id, batch_size=batch_size, **params)]
+            if not ids:
+                break
+
+            result = conn.execute(text(
+                f"UPDATE {table} SET {assignment} "
+                f"WHERE id >= :low AND id <= :high AND {condition}"
+            ), low=ids[0], high=ids[-1], **params)
+            updated += result.rowcount
+            if on_batch is not None:
+                on_batch(conn, ids[0], ids[-1])
+            last_id = ids[-1]
+
+        if pause:
+            time.sleep(pause)
+
+    return updated
+
+def backfill_column(table, column, value_sql, batch_size=1000, pause=0.1):
+    """
+        Sets column to value_sql for every row of table where it is still
+        null, in batches (see update_in_batches()). Returns the number of rows
+        updated.
+        type table: str
+        type column: str
+        type value_sql: str
+        type batch_size: int
+        type pause: float
+        rtype: int
+    """
+    return update_in_batches(table, f"{column} = {value_sql}", \
+        f"{column} IS NULL", batch_size, pause)
+
+def find_unindexed_foreign_keys():
+    """
+        Finds foreign keys whose columns aren't the leading columns of any
+        index (or of the primary key). Deleting a referenced row or joining on
+        such a key has to scan the whole referencing table.
+        rtype: list[tuple(str, tuple(str), str)]
+    """
+    inspector = inspect(db.engine)
+    unindexed = []
+
+    for table in inspector.get_table_names():
+        indexed_columns = \
+            [index["column_names"] for index in inspector.get_indexes(table)]
+        primary_key = \
+            inspector.get_pk_constraint(table)["constrained_columns"]
+        if primary_key:
+            indexed_columns.append(primary_key)
+
+        for fk in inspector.get_foreign_keys(table):
+            columns = fk["constrained_columns"]
+            covered = False
+            for index_columns in indexed_columns:
+                # an index can only be used if the fk columns lead it
+                if set(index_columns[:len(columns)]) == set(columns):
+                    covered = True
+            if not covered:
+                unindexed.append((table, tuple(columns), fk["referred_table"]))
+
+    return unindexed
+
+def add_post_and_tag_indexes():
+    """
+        Adds indexes for the home page ordering, looking up a user's posts, a
+        tag's posts and the user listing ordering
+    """
+    create_index_concurrently("ix_posts_created_at", "posts", ["created_at"])
+    create_index_concurrently("ix_posts_user_id", "posts", ["user_id"])
+    create_index_concurrently("ix_posts_tags_tag_id", "posts_tags", ["tag_id"])
+    create_index_concurrently("ix_users_last_name_first_name", "users", \
+        ["last_name", "first_name"])
+
+def add_feed_entries():
+    """
+        Adds the feed_entries table the home page is read from. It's filled in
+        by add_post_excerpts(), since entries are made from posts' excerpts.
+    """
+    tag_names_type = "TEXT[]" if is_postgres() else "JSON"
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS feed_entries ("
+            "post_id INTEGER NOT NULL PRIMARY KEY "
+            "REFERENCES posts (id) ON DELETE CASCADE, "
+            "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+            "created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+            "title TEXT NOT NULL, "
+            "excerpt TEXT NOT NULL, "
+            "author_name TEXT NOT NULL, "
+            "friendly_date TEXT NOT NULL, "
+            f"tag_names {tag_names_type} NOT NULL)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_feed_entries_created_at_post_id "
+            "ON feed_entries (created_at, post_id)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_feed_entries_user_id "
+            "ON feed_entries (user_id)"
+        ))
+
+def add_post_excerpts(batch_size=500):
+    """
+        Adds the excerpt column to posts, fills it in for the existing posts
+        the same way make_excerpt() did, then adds the missing feed entries
+        batch_size posts at a time. Entries that already exist are kept, so
+        the home page stays whole while this runs on a live db.
+        type batch_size: int
+    """
+    add_column("posts", "excerpt", "TEXT")
+    backfill_column("posts", "excerpt", \
+        f"CASE WHEN length(content) <= {EXCERPT_LENGTH} THEN content "
+        f"ELSE rtrim(substr(content, 1, {EXCERPT_LENGTH}), "
+        f"'{EXCERPT_WHITESPACE}') || '...' END")
+
+    postgres = is_postgres()
+    columns = "post_id, user_id, created_at, title, excerpt, author_name, " \
+        "friendly_date, tag_names"
+    values = ", ".join(f":{column}" for column in columns.split(", "))
+    if postgres:
+        insert = text(f"INSERT INTO feed_entries ({columns}) "
+            f"VALUES ({values}) ON CONFLICT DO NOTHING")
+    else:
+        insert = text(f"INSERT OR IGNORE INTO feed_entries ({columns}) "
+            f"VALUES ({values})")
+    insert = insert.bindparams(bindparam("created_at", type_=db.DateTime))
+    select_tag_names = text(
+        "SELECT posts_tags.post_id, tags.name FROM posts_tags "
+        "JOIN tags ON tags.id = posts_tags.tag_id "
+        "WHERE posts_tags.post_id IN :post_ids ORDER BY tags.name"
+    ).bindparams(bindparam("post_ids", expanding=True))
+
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            posts = conn.execute(text(
+                "SELECT posts.id, posts.user_id, posts.created_at, "
+                "posts.title, posts.excerpt, users.first_name, "
+                "users.last_name FROM posts "
+                "JOIN users ON users.id = posts.user_id "
+                "LEFT JOIN feed_entries ON feed_entries.post_id = posts.id "
+                "WHERE posts.id > :last_id AND feed_entries.post_id IS NULL "
+                "ORDER BY posts.id LIMIT :batch_size"
+            ).columns(created_at=db.DateTime), \
+                last_id=last_id, batch_size=batch_size).fetchall()
+            if not posts:
+                break
+
+            tag_names = {post.id: [] for post in posts}
+            for post_id, name in conn.execute(select_tag_names, \
+                post_ids=list(tag_names)):
+                tag_names[post_id].append(name)
+
+            conn.execute(insert, [{
+                "post_id": post.id,
+                "user_id": post.user_id,
+                "created_at": post.created_at,
+                "title": post.title,
+                "excerpt": post.excerpt,
+                "author_name": f"{post.first_name} {post.last_name}",
+                "friendly_date": \
+                    post.created_at.strftime(FRIENDLY_DATE_FORMAT),
+                "tag_names": tag_names[post.id] if postgres \
+                    else json.dumps(tag_names[post.id])
+            } for post in posts])
+            last_id = posts[-1].id
+
+def add_feed_versions():
+    """
+        Adds the feed_versions table that feed caches check for changes
+    """
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS feed_versions ("
+            "name TEXT NOT NULL PRIMARY KEY, version INTEGER NOT NULL)"
+        ))
+
+def convert_post_dates_to_utc(time_zone=None, batch_size=1000, pause=0.1):
+    """
+        Converts the created_at of posts from time_zone (by default Postgres'
+        time zone, which now() used) to UTC, along with their feed entries'
+        dates, and makes the column default to UTC. Other dbs already use UTC.
+        Only the posts that existed when the default was changed are
+        converted, and each batch records its progress, so running it again
+        carries on instead of converting any post twice.
+        type time_zone: str
+        type batch_size: int
+        type pause: float
+    """
+    if not is_postgres():
+        return
+
+    migration_id = "0005_utc_post_dates"
+    migration_progress.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        progress = conn.execute(migration_progress.select() \
+            .where(migration_progress.c.id == migration_id)).first()
+        if progress is None:
+            conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+            conn.execute(text(
+                "ALTER TABLE posts ALTER COLUMN created_at "
+                "SET DEFAULT timezone('utc', now())"
+            ))
+            # the ALTER's lock keeps posts from being added until it commits,
+            # so posts after max_id have the UTC default
+            max_id = conn.execute(text(
+                "SELECT COALESCE(MAX(id), 0) FROM posts"
+            )).scalar()
+            conn.execute(migration_progress.insert() \
+                .values(id=migration_id, max_id=max_id, last_id=0))
+            last_id = 0
+        else:
+            max_id, last_id = progress.max_id, progress.last_id
+
+    def convert_feed_dates(conn, low, high):
+        """
+            Copies the converted dates to the batch's feed entries and records
+            the batch as done
+        """
+        entries = [{"post_id": row.id, "created_at": row.created_at, \
+            "friendly_date": row.created_at.strftime(FRIENDLY_DATE_FORMAT)} \
+            for row in conn.execute(text(
+                "SELECT id, created_at FROM posts "
+                "WHERE id >= :low AND id <= :high AND created_at IS NOT NULL"
+            ), low=low, high=high)]
+        if entries:
+            conn.execute(text(
+                "UPDATE feed_entries SET created_at = :created_at, "
+                "friendly_date = :friendly_date WHERE post_id = :post_id"
+            ), entries)
+        conn.execute(migration_progress.update() \
+            .where(migration_progress.c.id == migration_id) \
+            .values(last_id=high))
+
+    zone = "current_setting('TimeZone')" if time_zone is None else ":zone"
+    update_in_batches("posts", f"created_at = created_at AT TIME ZONE {zone} "
+        "AT TIME ZONE 'UTC'", "id <= :max_id AND created_at IS NOT NULL", \
+        batch_size, pause, last_id, {"max_id": max_id, "zone": time_zone}, \
+        convert_feed_dates)
+
+def add_post_chunks(batch_size=100, pause=0.1):
+    """
+        Adds the post_chunks table posts' content is streamed from, and splits
+        the content of the posts that have no chunks yet, batch_size posts at
+        a time. Also lets Postgres compress content again, which an earlier
+        version of 0003_post_excerpts had turned off.
+        type batch_size: int
+        type pause: float
+    """
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS post_chunks ("
+            "post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE, "
+            "seq INTEGER NOT NULL, "
+            "body TEXT NOT NULL, "
+            "PRIMARY KEY (post_id, seq))"
+        ))
+
+    if is_postgres():
+        with db.engine.begin() as conn:
+            conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+            # only changes how values written from now on are stored
+            conn.execute(text(
+                "ALTER TABLE posts ALTER COLUMN content SET STORAGE EXTENDED"
+            ))
+        insert = text("INSERT INTO post_chunks (post_id, seq, body) "
+            "VALUES (:post_id, :seq, :body) ON CONFLICT DO NOTHING")
+    else:
+        insert = text("INSERT OR IGNORE INTO post_chunks (post_id, seq, body) "
+            "VALUES (:post_id, :seq, :body)")
+
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            posts = conn.execute(text(
+                "SELECT id, content FROM posts WHERE id > :last_id "
+                "AND NOT EXISTS (SELECT 1 FROM post_chunks "
+                "WHERE post_chunks.post_id = posts.id) "
+                "ORDER BY id LIMIT :batch_size"
+            ), last_id=last_id, batch_size=batch_size).fetchall()
+            if not posts:
+                break
+
+            chunks = [{"post_id": post.id, "seq": seq, \
+                "body": post.content[start:start + POST_CHUNK_SIZE]} \
+                for post in posts for seq, start in \
+                enumerate(range(0, len(post.content), POST_CHUNK_SIZE))]
+            if chunks:
+                conn.execute(insert, chunks)
+            last_id = posts[-1].id
+
+        if pause:
+            time.sleep(pause)
+
+def add_index_versions():
+    """
+        Adds the index_versions table that in memory indexes check for changes
+    """
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS index_versions ("
+            "name TEXT NOT NULL PRIMARY KEY, version INTEGER NOT NULL)"
+        ))
+
+# migrations are run in this order, and each is only ever run once per db
+MIGRATIONS = [
+    ("0001_post_and_tag_indexes", add_post_and_tag_indexes),
+    ("0002_feed_entries", add_feed_entries),
+    ("0003_post_excerpts", add_post_excerpts),
+    ("0004_feed_versions", add_feed_versions),
+    ("0005_utc_post_dates", convert_post_dates_to_utc),
+    ("0006_post_chunks", add_post_chunks),
+    ("0007_index_versions", add_index_versions),
+]
+
+@contextmanager
+def migration_lock():
+    """
+        Keeps any other process from changing the schema until the block
+        ends, like workers starting on an empty db at once or two runs of
+        "flask migrate". Only Postgres is locked, since the SQLite dbs used
+        in tests belong to a single process.
+    """
+    if not is_postgres():
+        yield
+        return
+
+    # a session lock outside of any transaction, so it's held across the
+    # migrations' own transactions without holding back concurrent index
+    # builds
+    conn = autocommit_connection()
+    try:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), \
+            id=MIGRATION_LOCK_ID)
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), \
+                id=MIGRATION_LOCK_ID)
+    finally:
+        conn.close()
+
+def run_migrations():
+    """
+        Runs every migration that hasn't been applied to the db yet, and
+        returns the ids of the migrations that were run. The caller must hold
+        migration_lock().
+        rtype: list[str]
+    """
+    schema_migrations.create(db.engine, checkfirst=True)
+    migration_progress.create(db.engine, checkfirst=True)
+    with db.engine.connect() as conn:
+        applied = \
+            {row[0] for row in conn.execute(schema_migrations.select())}
+
+    ran = []
+    for migration_id, migration in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        migration()
+        # a migration using the session mustn't hold locks into the next one
+        db.session.remove()
+        with db.engine.begin() as conn:
+            conn.execute(schema_migrations.insert().values(id=migration_id))
+        ran.append(migration_id)
+
+    return ran
+
+def upgrade():
+    """
+        Runs every migration that hasn't been applied to the db yet, once any
+        other process changing the schema is done, and returns the ids of the
+        migrations that were run
+        rtype: list[str]
+    """
+    with migration_lock():
+        return run_migrations()
+
+def bootstrap():
+    """
+        Creates every table if the db is empty, then runs every migration on
+        it, which only makes the changes the models can't describe (like
+        column defaults and storage) and records the migrations as applied.
+        A db that already has tables is left to upgrade(). Returns whether
+        the db was empty. Processes starting at once take turns, so only the
+        first creates the tables.
+        rtype: bool
+    """
+    with migration_lock():
+        if inspect(db.engine).get_table_names():
+            return False
+        db.create_all()
+        run_migrations()
+        return True
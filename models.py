@@ -1,9 +1,33 @@
 """Models for Blogly."""
 
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 
 db = SQLAlchemy()
 
+# number of characters of a post's content in its excerpt
+EXCERPT_LENGTH = 200
+
+# characters trimmed from the end of an excerpt
+EXCERPT_WHITESPACE = " \t\n\r\f\v"
+
+# number of characters of a post's content in each of its post_chunks rows
+CONTENT_CHUNK_SIZE = 8192
+
+# number of a post's chunks loaded by each query when streaming its content
+CHUNKS_PER_QUERY = 8
+
+def make_excerpt(content):
+    """
+        Gets the start of content for listings and feeds
+        type content: str
+        rtype: str
+    """
+    if len(content) <= EXCERPT_LENGTH:
+        return content
+    return content[:EXCERPT_LENGTH].rstrip(EXCERPT_WHITESPACE) + "..."
+
 def connect_db(app):
     db.app = app
     db.init_app(app)
@@ -15,6 +39,11 @@ class User(db.Model):
     """
     __tablename__ = "users"
 
+    # users are always listed ordered by last then first name
+    __table_args__ = (
+        db.Index("ix_users_last_name_first_name", "last_name", "first_name"),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     
     first_name = db.Column(db.Text, nullable=False)
@@ -43,8 +72,10 @@ class User(db.Model):
 class Post(db.Model):
     """
         Schema for the posts table in the db. Contains id, the title for the
-        post, the post's content, the date and time the post was created, and
-        a reference to the user who created the post.
+        post, the post's content, an excerpt of the content, the date and time
+        the post was created, and a reference to the user who created the post.
+        The content can be any length, so it's only loaded when it's used, and
+        it's also split into post_chunks rows to be streamed from.
     """
     __tablename__ = "posts"
 
@@ -52,11 +83,20 @@ class Post(db.Model):
 
     title = db.Column(db.Text, nullable=False)
 
-    content = db.Column(db.Text, nullable=False)
+    content = db.deferred(db.Column(db.Text, nullable=False))
 
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    # kept up to date from content by set_excerpt()
+    excerpt = db.Column(db.Text)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    # in UTC, which Postgres' now() isn't unless its time zone is UTC
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, \
+        index=True)
+
+    # the db deletes a post's chunks along with it
+    chunks = db.relationship("PostChunk", order_by="PostChunk.seq", \
+        cascade="all, delete-orphan", passive_deletes=True)
 
     @property
     def friendly_date(self):
@@ -65,9 +105,62 @@ class Post(db.Model):
         """
         return self.created_at.strftime("%a %b %#d %Y, %#I:%M %p")
 
+    @validates("content")
+    def set_excerpt(self, key, content):
+        """
+            Updates the excerpt and the chunks whenever the content is set
+        """
+        self.excerpt = make_excerpt(content)
+        self.chunks = [PostChunk(seq=seq, \
+            body=content[start:start + CONTENT_CHUNK_SIZE]) \
+            for seq, start in enumerate( \
+                range(0, len(content), CONTENT_CHUNK_SIZE))]
+        return content
+
+    def content_chunks(self, per_query=CHUNKS_PER_QUERY):
+        """
+            Loads the content from its chunks, per_query chunks at a time, so
+            a long post is never held in memory all at once. The session is
+            closed after each query, so no connection or transaction is held
+            while the chunks are used (like while they're sent to a slow
+            client), and anything that isn't loaded yet can't be loaded from
+            objects in the session afterwards.
+            type per_query: int
+            rtype: generator
+        """
+        seq = 0
+        while True:
+            bodies = [row[0] for row in db.session.query(PostChunk.body) \
+                .filter(PostChunk.post_id == self.id, PostChunk.seq >= seq) \
+                .order_by(PostChunk.seq).limit(per_query)]
+            db.session.close()
+            yield from bodies
+            if len(bodies) < per_query:
+                break
+            seq += per_query
+
     def __repr__(self):
         return \
-            f"<Post id={self.id} title={self.title} content={self.content} created_at={self.created_at} user_id={self.user_id}>"
+            f"<Post id={self.id} title={self.title} created_at={self.created_at} user_id={self.user_id}>"
+
+class PostChunk(db.Model):
+    """
+        Schema for the post_chunks table, which holds each post's content
+        split into CONTENT_CHUNK_SIZE characters long pieces, numbered by seq
+        from 0. Each chunk is read on its own through the primary key, so
+        streaming a post reads it once from start to end.
+    """
+    __tablename__ = "post_chunks"
+
+    post_id = db.Column(db.Integer, \
+        db.ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True)
+
+    seq = db.Column(db.Integer, primary_key=True)
+
+    body = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f"<PostChunk post_id={self.post_id} seq={self.seq}>"
 
 class Tag(db.Model):
     """
@@ -95,7 +188,106 @@ class PostTag(db.Model):
     post_id = \
         db.Column(db.Integer, db.ForeignKey("posts.id"), primary_key=True)
 
-    tag_id = db.Column(db.Integer, db.ForeignKey("tags.id"), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey("tags.id"), primary_key=True, \
+        index=True)
+
+    def __repr__(self):
+        return f"<PostTag post_id={self.post_id} tag_id={self.tag_id}>"
+
+class FeedEntry(db.Model):
+    """
+        Schema for the feed_entries table, a copy of what the home page shows
+        for each post (its title, an excerpt of its content, its author's name,
+        its date and its tag names), so the home page reads one table instead
+        of joining posts, users and tags. Kept up to date by the views that
+        change posts, users or tags, in the same transaction as the change.
+    """
+    __tablename__ = "feed_entries"
+
+    # the home page reads entries newest first
+    __table_args__ = (
+        db.Index("ix_feed_entries_created_at_post_id", "created_at", \
+            "post_id"),
+    )
+
+    post_id = db.Column(db.Integer, \
+        db.ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True)
+
+    user_id = db.Column(db.Integer, \
+        db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False, \
+        index=True)
+
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    title = db.Column(db.Text, nullable=False)
+
+    excerpt = db.Column(db.Text, nullable=False)
+
+    author_name = db.Column(db.Text, nullable=False)
+
+    friendly_date = db.Column(db.Text, nullable=False)
+
+    tag_names = db.Column(db.ARRAY(db.Text).with_variant(db.JSON, "sqlite"), \
+        nullable=False)
+
+    def __repr__(self):
+        return \
+            f"<FeedEntry post_id={self.post_id} title={self.title} author_name={self.author_name} tag_names={self.tag_names}>"
+
+class FeedVersion(db.Model):
+    """
+        Schema for the feed_versions table, which counts the changes to each
+        Atom feed. Every process serving feeds reads the versions from here to
+        tell whether the feeds it has cached are still current.
+    """
+    __tablename__ = "feed_versions"
+
+    name = db.Column(db.Text, primary_key=True)
+
+    version = db.Column(db.Integer, nullable=False)
 
     def __repr__(self):
-        return f"<PostTag post_id={self.post_id} tag_id={self.tag_id}>"
\ No newline at end of file
+        return f"<FeedVersion name={self.name} version={self.version}>"
+
+class IndexVersion(db.Model):
+    """
+        Schema for the index_versions table, which counts the changes to the
+        rows each in memory index (like the tag index) is built from. Every
+        process keeping an index reads its version from here to tell whether
+        another process has changed those rows since.
+    """
+    __tablename__ = "index_versions"
+
+    name = db.Column(db.Text, primary_key=True)
+
+    version = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<IndexVersion name={self.name} version={self.version}>"
+
+def get_index_version(name):
+    """
+        Gets the version of index name, which is 0 until it's first bumped
+        type name: str
+        rtype: int
+    """
+    version = db.session.query(IndexVersion.version) \
+        .filter(IndexVersion.name == name).scalar()
+    return version or 0
+
+def bump_index_version(name):
+    """
+        Adds one to the version of index name and returns the new version.
+        Call it once the write that changed the index's rows is committed,
+        since it commits on its own.
+        type name: str
+        rtype: int
+    """
+    db.session.execute(db.text(
+        "INSERT INTO index_versions (name, version) VALUES (:name, 1) "
+        "ON CONFLICT (name) DO UPDATE "
+        "SET version = index_versions.version + 1"
+    ), {"name": name})
+    version = get_index_version(name)
+    db.session.commit()
+    return version
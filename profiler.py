@@ -0,0 +1,311 @@
+"""Request profiling for Blogly."""
+
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from threading import Event, Thread, get_ident
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# endings of the files profiles are saved to, so others are left alone
+PROFILE_SUFFIXES = (".speedscope.json", ".collapsed.txt")
+
+# ending of the file saved next to a collapsed profile with the request's SQL,
+# since collapsed stacks have no room for anything but stacks
+STATEMENTS_SUFFIX = ".sql.json"
+
+# requests being profiled, by the id of the thread handling them
+active_profiles = {}
+
+def sql_frame(statement):
+    """
+        Makes a frame standing for the time spent waiting on statement, so the
+        profile shows which queries the db was busy with
+        type statement: str
+        rtype: tuple(str, str, int)
+    """
+    statement = " ".join(statement.split())
+    if len(statement) > 80:
+        statement = statement[:77] + "..."
+    return (f"SQL: {statement}", "<db>", 0)
+
+class RequestProfile:
+    """
+        Samples the Python stack of the thread handling a request every
+        interval seconds from a background thread, and records the SQL
+        statements the request runs and how long each took. While a statement
+        is running, samples end with a frame for it.
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.statements = []
+        self.current_statement = None
+        self.statement_started = None
+        self.started = time.perf_counter()
+        self.duration = None
+        self.stopped = Event()
+        self.sampler = Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        """
+            Starts sampling
+        """
+        self.sampler.start()
+
+    def stop(self):
+        """
+            Stops sampling and waits for the sampler to finish
+        """
+        self.duration = time.perf_counter() - self.started
+        self.stopped.set()
+        self.sampler.join()
+
+    def sample(self):
+        """
+            Takes samples until stopped. Frames are identified by their
+            function rather than their line, so all time in a function adds up.
+        """
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, \
+                    code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+
+            statement = self.current_statement
+            if statement is not None:
+                stack.append(sql_frame(statement))
+            if stack:
+                self.samples[tuple(stack)] += 1
+
+    def start_statement(self, statement):
+        """
+            Records that statement has started running
+            type statement: str
+        """
+        self.current_statement = statement
+        self.statement_started = time.perf_counter()
+
+    def end_statement(self):
+        """
+            Records that the running statement has finished
+        """
+        if self.current_statement is None:
+            return
+        self.statements.append((self.current_statement, \
+            time.perf_counter() - self.statement_started))
+        self.current_statement = None
+
+    def summary(self):
+        """
+            Describes the request, its duration and the time it spent on SQL
+            rtype: str
+        """
+        sql_time = sum(duration for statement, duration in self.statements)
+        return f"{request.method} {request.path} " \
+            f"({self.duration * 1000:.1f}ms, {len(self.statements)} " \
+            f"queries taking {sql_time * 1000:.1f}ms)"
+
+    def statement_list(self):
+        """
+            Gets every SQL statement the request ran, in order, with how long
+            each took in milliseconds
+            rtype: list[dict]
+        """
+        return [{"sql": statement, "milliseconds": duration * 1000} \
+            for statement, duration in self.statements]
+
+    def to_speedscope(self):
+        """
+            Gets the profile in speedscope's file format. Every SQL statement
+            is also listed under statements (which speedscope ignores), since
+            statements quicker than the sampling interval miss the samples.
+            rtype: dict
+        """
+        frames = []
+        frame_ids = {}
+        samples = []
+        weights = []
+        for stack, count in self.samples.items():
+            sample = []
+            for frame in stack:
+                if frame not in frame_ids:
+                    frame_ids[frame] = len(frames)
+                    name, file, line = frame
+                    frames.append({"name": name, "file": file, "line": line})
+                sample.append(frame_ids[frame])
+            samples.append(sample)
+            weights.append(count * self.interval * 1000)
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "blogly",
+            "name": self.summary(),
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.summary(),
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights
+            }],
+            "statements": self.statement_list()
+        }
+
+    def to_collapsed(self):
+        """
+            Gets the profile as collapsed stacks, one line per stack with the
+            number of samples in it, as read by flamegraph.pl and speedscope.
+            The format has nothing but stacks, so the request and its SQL are
+            left to to_statements().
+            rtype: str
+        """
+        lines = []
+        for stack, count in self.samples.items():
+            names = []
+            for name, file, line in stack:
+                frame = f"{name} ({file}:{line})" if line else name
+                names.append(frame.replace(";", ","))
+            lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_statements(self):
+        """
+            Gets the request and every SQL statement it ran, for saving next to
+            a collapsed profile
+            rtype: dict
+        """
+        return {"name": self.summary(), "statements": self.statement_list()}
+
+def prune_profiles(directory, max_files):
+    """
+        Deletes the oldest profiles in directory, along with the SQL saved
+        next to them, so at most max_files profiles are kept
+        type directory: str
+        type max_files: int
+    """
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) \
+        if name.endswith(PROFILE_SUFFIXES)]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:max(0, len(paths) - max_files)]:
+        old_paths = [path]
+        if path.endswith(".collapsed.txt"):
+            old_paths.append(path[:-len(".collapsed.txt")] + STATEMENTS_SUFFIX)
+        for old_path in old_paths:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                # another request pruned it first, or there was no SQL file
+                pass
+
+def save_profile(profile):
+    """
+        Writes profile to PROFILE_DIR in PROFILE_FORMAT, then prunes the
+        directory to PROFILE_MAX_FILES
+        type profile: RequestProfile
+        rtype: str
+    """
+    config = current_app.config
+    directory = config["PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{get_ident()}-" \
+        f"{request.endpoint}-{profile.duration * 1000:.0f}ms"
+    if config["PROFILE_FORMAT"] == "collapsed":
+        path = os.path.join(directory, f"{name}.collapsed.txt")
+        with open(path, "w") as profile_file:
+            profile_file.write(profile.to_collapsed())
+        with open(os.path.join(directory, f"{name}{STATEMENTS_SUFFIX}"), \
+            "w") as statements_file:
+            json.dump(profile.to_statements(), statements_file)
+    else:
+        path = os.path.join(directory, f"{name}.speedscope.json")
+        with open(path, "w") as profile_file:
+            json.dump(profile.to_speedscope(), profile_file)
+
+    prune_profiles(directory, config["PROFILE_MAX_FILES"])
+    return path
+
+def should_profile():
+    """
+        Decides whether to profile the current request, which is the case for
+        every request to an endpoint in PROFILE_ROUTES and for a
+        PROFILE_SAMPLE_RATE fraction of all other requests
+        rtype: bool
+    """
+    config = current_app.config
+    if request.endpoint is None or request.endpoint == "static":
+        return False
+    if request.endpoint in config["PROFILE_ROUTES"]:
+        return True
+    return random.random() < config["PROFILE_SAMPLE_RATE"]
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, \
+    executemany):
+    profile = active_profiles.get(get_ident())
+    if profile is not None:
+        profile.start_statement(statement)
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    profile = active_profiles.get(get_ident())
+    if profile is not None:
+        profile.end_statement()
+
+def init_profiler(app):
+    """
+        Profiles requests chosen by PROFILE_ROUTES and PROFILE_SAMPLE_RATE
+        (neither is profiled by default), sampling their stack every
+        PROFILE_INTERVAL seconds and recording their SQL, and writes each
+        profile to PROFILE_DIR as a PROFILE_FORMAT ("speedscope" or
+        "collapsed") file, keeping the newest PROFILE_MAX_FILES. Collapsed
+        profiles have their SQL saved next to them in a .sql.json file.
+        type app: Flask
+    """
+    app.config.setdefault("PROFILE_ROUTES", [])
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0.0)
+    app.config.setdefault("PROFILE_INTERVAL", 0.005)
+    app.config.setdefault("PROFILE_DIR", "profiles")
+    app.config.setdefault("PROFILE_FORMAT", "speedscope")
+    app.config.setdefault("PROFILE_MAX_FILES", 100)
+
+    @app.before_request
+    def start_profile():
+        """
+            Starts profiling the request if it was chosen to be
+        """
+        if not should_profile():
+            return
+        profile = RequestProfile(get_ident(), \
+            current_app.config["PROFILE_INTERVAL"])
+        active_profiles[profile.thread_id] = profile
+        g.profile = profile
+        profile.start()
+
+    @app.teardown_request
+    def save_request_profile(exc):
+        """
+            Stops profiling the request and saves its profile
+        """
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        active_profiles.pop(profile.thread_id, None)
+        profile.stop()
+        try:
+            save_profile(profile)
+        except OSError:
+            current_app.logger.exception("Couldn't save request profile")
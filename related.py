@@ -0,0 +1,473 @@
+"""Related post recommendations for Blogly."""
+
+from threading import Lock, Thread, Event
+import numpy as np
+from scipy import sparse
+from models import db, PostTag, get_index_version, bump_index_version
+
+# number of related posts kept for each post
+RELATED_SIZE = 5
+
+# number of posts scored at once when building
+BUILD_CHUNK = 1000
+
+# most pairs of posts sharing a tag that are counted at once when building,
+# to bound memory however many posts a tag is on
+BUILD_PAIRS = 2000000
+
+# seconds between rescoring the posts left stale by updates
+REFRESH_INTERVAL = 5.0
+
+# name of the related posts in the index_versions table
+RELATED_POSTS_VERSION = "related_posts"
+
+EMPTY = np.zeros(0, dtype=np.int32)
+
+class RelatedPosts:
+    """
+        Precomputed related posts, where posts are related by how many tags
+        they share. Keeps the tags on each post and the posts with each tag as
+        sparse matrices, the tag co-occurrence matrix, and the related posts
+        for each post as a row of ids and a row of scores in two (posts, size)
+        matrices, where unused places have a score of 0. build() computes
+        everything from the posts_tags rows, and update() keeps it current
+        when a post's tags change by rescoring that post and patching its
+        score into the others. Patching can't tell when a post that wasn't
+        kept should replace one whose score dropped, so those posts are left
+        for refresh_stale(). version is the version of the rows in the db the
+        store is up to date with, or None if it's unknown.
+    """
+    def __init__(self, size=RELATED_SIZE, max_pairs=BUILD_PAIRS):
+        self.lock = Lock()
+        self.size = size
+        self.max_pairs = max_pairs
+        self.reset()
+        self.version = None
+
+    def reset(self):
+        """
+            Empties the store
+        """
+        self.incidence = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.by_tag = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.related = np.zeros((0, self.size), dtype=np.int32)
+        self.scores = np.zeros((0, self.size), dtype=np.int32)
+        self.stale = set()
+        self.cooccurrence = sparse.csr_matrix((0, 0), dtype=np.int32)
+
+    def build(self, post_ids, tag_ids, version=None):
+        """
+            Computes the co-occurrence matrix and related posts from scratch,
+            where post_ids[i] is tagged with tag_ids[i] in the rows at version
+            type post_ids: list[int]
+            type tag_ids: list[int]
+            type version: int
+        """
+        post_ids = np.asarray(post_ids, dtype=np.int32)
+        tag_ids = np.asarray(tag_ids, dtype=np.int32)
+        if not len(post_ids):
+            with self.lock:
+                self.reset()
+                self.version = version
+            return
+
+        # posts x tags, with a 1 wherever a post has a tag
+        incidence = sparse.csr_matrix(
+            (np.ones(len(post_ids), dtype=np.int32), (post_ids, tag_ids)),
+            shape=(post_ids.max() + 1, tag_ids.max() + 1)
+        )
+        incidence.sort_indices()
+        by_tag = incidence.T.tocsr()
+        by_tag.sort_indices()
+
+        # tags x tags, counting the posts each pair of tags is on together
+        cooccurrence = (by_tag @ incidence).tocsr()
+
+        # the most posts each post can share a tag with
+        reach = incidence @ np.diff(by_tag.indptr).astype(np.int64)
+
+        # posts x posts, counting the tags each pair of posts shares, a chunk
+        # of posts at a time, against as many ranges of posts as it takes to
+        # keep each product under max_pairs
+        num_of_rows = incidence.shape[0]
+        related = np.zeros((num_of_rows, self.size), dtype=np.int32)
+        scores = np.zeros((num_of_rows, self.size), dtype=np.int32)
+        posts = np.unique(post_ids)
+        for start in range(0, len(posts), BUILD_CHUNK):
+            chunk = posts[start:start + BUILD_CHUNK]
+            parts = max(1, -(-int(reach[chunk].sum()) // self.max_pairs))
+            bounds = np.linspace(0, num_of_rows, parts + 1).astype(int)
+            chunk_tags = incidence[chunk]
+            for low, high in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                if low == high:
+                    continue
+                shared = (chunk_tags @ incidence[low:high].T).tocsr()
+                for row, post in enumerate(chunk.tolist()):
+                    begin, end = shared.indptr[row], shared.indptr[row + 1]
+                    kept = np.count_nonzero(scores[post])
+                    put_row(related, scores, post, *self.top(post, \
+                        np.concatenate((related[post, :kept], \
+                            shared.indices[begin:end] + low)), \
+                        np.concatenate((scores[post, :kept], \
+                            shared.data[begin:end]))))
+
+        with self.lock:
+            self.incidence = incidence
+            self.by_tag = by_tag
+            self.related = related
+            self.scores = scores
+            self.stale = set()
+            self.cooccurrence = cooccurrence
+            self.version = version
+
+    def changed(self, version):
+        """
+            Records that the rows moved on to version with a change already
+            made to the store. If they also changed in another process since
+            the store's version, the store stays behind so it's rebuilt.
+            type version: int
+        """
+        with self.lock:
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def top(self, post_id, candidates, scores):
+        """
+            Picks the highest scoring candidates other than post_id, with
+            newer posts first when scores are tied, and their scores
+            type post_id: int
+            type candidates: np.ndarray
+            type scores: np.ndarray
+            rtype: tuple(np.ndarray, np.ndarray)
+        """
+        keep = (candidates != post_id) & (scores > 0)
+        candidates, scores = candidates[keep], scores[keep]
+        order = np.lexsort((-candidates, -scores))[:self.size]
+        return candidates[order].astype(np.int32), \
+            scores[order].astype(np.int32)
+
+    def kept(self, post_id):
+        """
+            Gets the related posts kept for post_id and their scores
+            type post_id: int
+            rtype: tuple(np.ndarray, np.ndarray)
+        """
+        if post_id >= len(self.related):
+            return EMPTY, EMPTY
+        count = np.count_nonzero(self.scores[post_id])
+        return self.related[post_id, :count], self.scores[post_id, :count]
+
+    def store(self, post_id, related, scores):
+        """
+            Saves the related posts for post_id and their scores, growing the
+            matrices (to twice their rows, so they're rarely copied) if
+            post_id is past their end
+            type post_id: int
+            type related: np.ndarray
+            type scores: np.ndarray
+        """
+        if post_id >= len(self.related):
+            if not len(related):
+                return
+            num_of_rows = max(post_id + 1, 2 * len(self.related))
+            self.related = grow_rows(self.related, num_of_rows)
+            self.scores = grow_rows(self.scores, num_of_rows)
+        put_row(self.related, self.scores, post_id, related, scores)
+
+    def shared_counts(self, tags, post_id):
+        """
+            Counts how many of tags each post other than post_id has
+            type tags: np.ndarray
+            type post_id: int
+            rtype: tuple(np.ndarray, np.ndarray)
+        """
+        lists = [row_of(self.by_tag, tag) for tag in tags.tolist()]
+        if not lists:
+            return EMPTY, EMPTY
+        posts, counts = \
+            np.unique(np.concatenate(lists), return_counts=True)
+        keep = posts != post_id
+        return posts[keep], counts[keep]
+
+    def score(self, post_id):
+        """
+            Finds the related posts for post_id from the posts with each of its
+            tags, and their scores
+            type post_id: int
+            rtype: tuple(np.ndarray, np.ndarray)
+        """
+        tags = row_of(self.incidence, post_id)
+        return self.top(post_id, *self.shared_counts(tags, post_id))
+
+    def patch(self, post_id, other_id, score):
+        """
+            Changes the score of other_id in the related posts of post_id. If
+            other_id drops in a full list, a post that isn't kept might now
+            belong in it, so post_id is marked stale for refresh_stale().
+            type post_id: int
+            type other_id: int
+            type score: int
+        """
+        related, scores = self.kept(post_id)
+        full = len(related) >= self.size
+        found = related == other_id
+        old_score = scores[found][0] if found.any() else 0
+
+        related = np.concatenate((related[~found], [other_id]))
+        scores = np.concatenate((scores[~found], [score]))
+        self.store(post_id, *self.top(post_id, related, scores))
+        if full and score < old_score:
+            self.stale.add(post_id)
+
+    def set_tags(self, post_id, tag_ids):
+        """
+            Changes the tags on post_id without taking the lock. Only post_id
+            is rescored; the posts whose tags it gained or lost have its score
+            patched into their related posts.
+            type post_id: int
+            type tag_ids: list[int]
+        """
+        old = row_of(self.incidence, post_id)
+        new = np.unique(np.asarray(tag_ids, dtype=np.int32))
+        removed = np.setdiff1d(old, new)
+        added = np.setdiff1d(new, old)
+
+        tags = np.concatenate((removed, added))
+        changes = np.concatenate((np.full(len(removed), -1, dtype=np.int32), \
+            np.ones(len(added), dtype=np.int32)))
+        posts = np.full(len(tags), post_id, dtype=np.int32)
+        self.incidence = add_entries(self.incidence, posts, tags, changes)
+        self.by_tag = add_entries(self.by_tag, tags, posts, changes)
+
+        # one less for every pair of old tags and one more for every new pair
+        old_rows, old_cols = tag_pairs(old)
+        new_rows, new_cols = tag_pairs(new)
+        self.cooccurrence = add_entries(self.cooccurrence, \
+            np.concatenate((old_rows, new_rows)), \
+            np.concatenate((old_cols, new_cols)), \
+            np.concatenate((np.full(len(old_rows), -1, dtype=np.int32), \
+                np.ones(len(new_rows), dtype=np.int32))), square=True)
+
+        posts, counts = self.shared_counts(new, post_id)
+        self.store(post_id, *self.top(post_id, posts, counts))
+
+        # only posts with a tag that was added or removed change score
+        changed = np.union1d(self.shared_counts(removed, post_id)[0], \
+            self.shared_counts(added, post_id)[0])
+        index = np.searchsorted(posts, changed)
+        found = index < len(posts)
+        found[found] = posts[index[found]] == changed[found]
+        new_scores = np.zeros(len(changed), dtype=np.int32)
+        new_scores[found] = counts[index[found]]
+        for other, score in zip(changed.tolist(), new_scores.tolist()):
+            self.patch(other, post_id, score)
+
+    def update(self, post_id, tag_ids):
+        """
+            Changes the tags on post_id to tag_ids
+            type post_id: int
+            type tag_ids: list[int]
+        """
+        with self.lock:
+            self.set_tags(post_id, tag_ids)
+
+    def remove(self, post_id):
+        """
+            Removes post_id, which has been deleted
+            type post_id: int
+        """
+        with self.lock:
+            self.set_tags(post_id, [])
+            self.stale.discard(post_id)
+
+    def remove_tag(self, tag_id):
+        """
+            Removes tag_id, which has been deleted, from every post. Every pair
+            of posts that had it loses one from their score, which is patched
+            into the related posts each of them keeps.
+            type tag_id: int
+        """
+        with self.lock:
+            posts = row_of(self.by_tag, tag_id)
+            tags = np.full(len(posts), tag_id, dtype=np.int32)
+            changes = np.full(len(posts), -1, dtype=np.int32)
+            self.incidence = add_entries(self.incidence, posts, tags, changes)
+            self.by_tag = add_entries(self.by_tag, tags, posts, changes)
+
+            if tag_id < self.cooccurrence.shape[0]:
+                keep = np.ones(self.cooccurrence.shape[0], dtype=np.int32)
+                keep[tag_id] = 0
+                mask = sparse.diags(keep, dtype=np.int32)
+                cooccurrence = (mask @ self.cooccurrence @ mask).tocsr()
+                cooccurrence.eliminate_zeros()
+                self.cooccurrence = cooccurrence
+
+            for post in posts.tolist():
+                related, scores = self.kept(post)
+                shared = np.isin(related, posts)
+                if not shared.any():
+                    continue
+                full = len(related) >= self.size
+                self.store(post, *self.top(post, related, scores - shared))
+                if full:
+                    self.stale.add(post)
+
+    def refresh_stale(self):
+        """
+            Rescores the posts marked stale by patch() and remove_tag(), taking
+            the lock for one post at a time so reads aren't held up
+            rtype: int
+        """
+        refreshed = 0
+        while True:
+            with self.lock:
+                if not self.stale:
+                    return refreshed
+                post = self.stale.pop()
+                self.store(post, *self.score(post))
+            refreshed += 1
+
+    def start_refresher(self, interval=REFRESH_INTERVAL):
+        """
+            Starts a background thread that calls refresh_stale() every
+            interval seconds, so requests never wait on it. Returns an event
+            that stops the thread when set.
+            type interval: float
+            rtype: Event
+        """
+        stopped = Event()
+
+        def refresh():
+            while not stopped.wait(interval):
+                self.refresh_stale()
+
+        Thread(target=refresh, daemon=True).start()
+        return stopped
+
+    def get(self, post_id):
+        """
+            Gets the ids of the posts related to post_id, most related first
+            type post_id: int
+            rtype: list[int]
+        """
+        with self.lock:
+            return self.kept(post_id)[0].tolist()
+
+    def related_tags(self, tag_id):
+        """
+            Gets the ids of the tags most often on the same posts as tag_id,
+            most often first
+            type tag_id: int
+            rtype: list[int]
+        """
+        with self.lock:
+            if tag_id >= self.cooccurrence.shape[0]:
+                return []
+            row = self.cooccurrence.getrow(tag_id)
+        keep = row.indices != tag_id
+        tags, counts = row.indices[keep], row.data[keep]
+        order = np.lexsort((tags, -counts))[:self.size]
+        return tags[order].tolist()
+
+def row_of(matrix, index):
+    """
+        Gets the column indices of row index of a csr matrix, which are empty
+        past its last row
+        type matrix: sparse.csr_matrix
+        type index: int
+        rtype: np.ndarray
+    """
+    if index >= matrix.shape[0]:
+        return EMPTY
+    begin, end = matrix.indptr[index], matrix.indptr[index + 1]
+    return matrix.indices[begin:end].astype(np.int32)
+
+def put_row(related, scores, post_id, ids, values):
+    """
+        Overwrites row post_id of the related and scores matrices with ids and
+        values, leaving the rest of the row empty
+        type related: np.ndarray
+        type scores: np.ndarray
+        type post_id: int
+        type ids: np.ndarray
+        type values: np.ndarray
+    """
+    related[post_id] = 0
+    scores[post_id] = 0
+    related[post_id, :len(ids)] = ids
+    scores[post_id, :len(values)] = values
+
+def grow_rows(matrix, num_of_rows):
+    """
+        Gets a copy of matrix with empty rows added up to num_of_rows
+        type matrix: np.ndarray
+        type num_of_rows: int
+        rtype: np.ndarray
+    """
+    grown = np.zeros((num_of_rows, matrix.shape[1]), dtype=matrix.dtype)
+    grown[:len(matrix)] = matrix
+    return grown
+
+def tag_pairs(tags):
+    """
+        Gets the rows and columns of every pair of tags, including each tag
+        with itself
+        type tags: np.ndarray
+        rtype: tuple(np.ndarray, np.ndarray)
+    """
+    return np.repeat(tags, len(tags)), np.tile(tags, len(tags))
+
+def add_entries(matrix, rows, cols, values, square=False):
+    """
+        Adds values[i] to (rows[i], cols[i]) of a csr matrix, growing it to
+        fit (in both directions alike if it's square), and drops the entries
+        that become 0
+        type matrix: sparse.csr_matrix
+        type rows: np.ndarray
+        type cols: np.ndarray
+        type values: np.ndarray
+        type square: bool
+        rtype: sparse.csr_matrix
+    """
+    if not len(rows):
+        return matrix
+    num_of_rows = max(matrix.shape[0], int(rows.max()) + 1)
+    num_of_cols = max(matrix.shape[1], int(cols.max()) + 1)
+    if square:
+        num_of_rows = num_of_cols = max(num_of_rows, num_of_cols)
+    shape = (num_of_rows, num_of_cols)
+
+    delta = sparse.csr_matrix((values, (rows, cols)), shape=shape)
+    matrix = matrix.copy()
+    matrix.resize(shape)
+    matrix = (matrix + delta).tocsr()
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return matrix
+
+related_posts = RelatedPosts()
+
+def build_related_posts():
+    """
+        Rebuilds related_posts from every row in the posts_tags table
+    """
+    # read first, so a write committed while the rows are read is seen again
+    version = get_index_version(RELATED_POSTS_VERSION)
+    rows = db.session.query(PostTag.post_id, PostTag.tag_id).all()
+    related_posts.build([row[0] for row in rows], [row[1] for row in rows], \
+        version)
+
+def sync_related_posts():
+    """
+        Rebuilds related_posts if another process has changed the posts' tags
+        since it was built, so call it before reading related_posts
+    """
+    if get_index_version(RELATED_POSTS_VERSION) != related_posts.version:
+        build_related_posts()
+
+def related_posts_changed():
+    """
+        Tells the other processes related_posts is out of date, once a
+        committed write has been made to it here as well
+    """
+    related_posts.changed(bump_index_version(RELATED_POSTS_VERSION))
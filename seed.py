@@ -1,8 +1,10 @@
 from app import app
 from models import db, User, Post, Tag, PostTag
+from home_feed import build_feed_entries
+from migrations import bootstrap
 
 db.drop_all()
-db.create_all()
+bootstrap()
 
 User.query.delete()
 Post.query.delete()
@@ -45,6 +47,9 @@ posts_tags = \
 db.session.add_all(posts_tags)
 db.session.commit()
 
+# fill in the home page's feed from the posts added above
+build_feed_entries()
+
 # for playing around only
 def get_users():
     return User.query.all()
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""Tag filtering for Blogly."""
+
+from threading import Lock
+from pyroaring import BitMap
+from models import db, Post, Tag, PostTag, get_index_version, \
+    bump_index_version
+
+# number of posts on each page of filtered posts
+PAGE_SIZE = 10
+
+# name of the tag index in the index_versions table
+TAG_INDEX_VERSION = "tag_index"
+
+class TagQueryError(ValueError):
+    """
+        Raised when a tag query can't be parsed.
+    """
+
+def parse_tag_query(query):
+    """
+        Parses a tag query into clauses that must all match. Clauses are
+        separated by commas, and each clause is a list of tag names separated
+        by | where any one of them must match. A clause starting with - must
+        not match. For example, "funny|very funny,profound,-work" is posts
+        tagged funny or very funny, and profound, and not work. Returns a list
+        of (negated, names) tuples.
+        type query: str
+        rtype: list[tuple(bool, list[str])]
+    """
+    clauses = []
+    for clause in query.split(","):
+        clause = clause.strip()
+        if not clause:
+            continue
+        negated = clause.startswith("-")
+        if negated:
+            clause = clause[1:]
+        names = [name.strip() for name in clause.split("|")]
+        if not all(names):
+            raise TagQueryError(f"Missing a tag name in \"{clause}\"")
+        clauses.append((negated, names))
+    return clauses
+
+class TagIndex:
+    """
+        Compressed bitmaps of the ids of the posts with each tag, so any
+        combination of tags can be filtered on with a few set operations
+        instead of joining posts_tags once per tag. Also keeps a bitmap of every
+        post, which NOT clauses are taken out of. version is the version of
+        the rows in the db the index is up to date with, or None if it's
+        unknown.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.all_posts = BitMap()
+        self.tag_posts = {}
+        self.tag_ids = {}
+        self.version = None
+
+    def build(self, post_ids, tags, post_tags, version=None):
+        """
+            Builds the index from scratch, from the rows at version
+            type post_ids: list[int]
+            type tags: list[tuple(int, str)]
+            type post_tags: list[tuple(int, int)]
+            type version: int
+        """
+        tag_posts = {tag_id: BitMap() for tag_id, name in tags}
+        for post_id, tag_id in post_tags:
+            tag_posts[tag_id].add(post_id)
+
+        with self.lock:
+            self.all_posts = BitMap(post_ids)
+            self.tag_posts = tag_posts
+            self.tag_ids = {name: tag_id for tag_id, name in tags}
+            self.version = version
+
+    def changed(self, version):
+        """
+            Records that the rows moved on to version with a change already
+            made to the index. If they also changed in another process since
+            the index's version, the index stays behind so it's rebuilt.
+            type version: int
+        """
+        with self.lock:
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def set_post(self, post_id, tag_ids):
+        """
+            Adds post_id, or if it already exists changes its tags, so it has
+            the tags in tag_ids
+            type post_id: int
+            type tag_ids: list[int]
+        """
+        tag_ids = set(tag_ids)
+        with self.lock:
+            self.all_posts.add(post_id)
+            for tag_id, posts in self.tag_posts.items():
+                if tag_id in tag_ids:
+                    posts.add(post_id)
+                else:
+                    posts.discard(post_id)
+
+    def remove_post(self, post_id):
+        """
+            Removes post_id, which has been deleted
+            type post_id: int
+        """
+        with self.lock:
+            self.all_posts.discard(post_id)
+            for posts in self.tag_posts.values():
+                posts.discard(post_id)
+
+    def set_tag(self, tag_id, name):
+        """
+            Adds tag_id, or if it already exists renames it, so it has name
+            type tag_id: int
+            type name: str
+        """
+        with self.lock:
+            self.tag_posts.setdefault(tag_id, BitMap())
+            self.tag_ids = {other_name: other_id for other_name, other_id \
+                in self.tag_ids.items() if other_id != tag_id}
+            self.tag_ids[name] = tag_id
+
+    def remove_tag(self, tag_id):
+        """
+            Removes tag_id, which has been deleted
+            type tag_id: int
+        """
+        with self.lock:
+            self.tag_posts.pop(tag_id, None)
+            self.tag_ids = {name: other_id for name, other_id \
+                in self.tag_ids.items() if other_id != tag_id}
+
+    def query(self, query):
+        """
+            Finds the ids of the posts matching query (see parse_tag_query()).
+            Tag names that don't exist match no posts.
+            type query: str
+            rtype: BitMap
+        """
+        clauses = parse_tag_query(query)
+
+        with self.lock:
+            included = [self.all_posts]
+            excluded = []
+            for negated, names in clauses:
+                matches = BitMap.union(BitMap(), *[self.tag_posts[tag_id] \
+                    for tag_id in (self.tag_ids.get(name) for name in names) \
+                    if tag_id is not None])
+                if negated:
+                    excluded.append(matches)
+                else:
+                    included.append(matches)
+
+            # intersect the smallest bitmaps first so the result shrinks fast
+            included.sort(key=len)
+            result = BitMap.intersection(*included)
+            if excluded:
+                result = result - BitMap.union(*excluded)
+        return result
+
+tag_index = TagIndex()
+
+def page_of(post_ids, page):
+    """
+        Gets the ids on page of post_ids, newest (highest id) first, along with
+        the number of pages
+        type post_ids: BitMap
+        type page: int
+        rtype: tuple(list[int], int)
+    """
+    total = len(post_ids)
+    num_of_pages = max(1, -(-total // PAGE_SIZE))
+    end = total - (page - 1) * PAGE_SIZE
+    if end <= 0:
+        return [], num_of_pages
+    start = max(0, end - PAGE_SIZE)
+    return list(reversed(list(post_ids[start:end]))), num_of_pages
+
+def build_tag_index():
+    """
+        Rebuilds tag_index from the posts, tags and posts_tags tables
+    """
+    # read first, so a write committed while the rows are read is seen again
+    version = get_index_version(TAG_INDEX_VERSION)
+    post_ids = [row[0] for row in db.session.query(Post.id)]
+    tags = db.session.query(Tag.id, Tag.name).all()
+    post_tags = db.session.query(PostTag.post_id, PostTag.tag_id).all()
+    tag_index.build(post_ids, tags, post_tags, version)
+
+def sync_tag_index():
+    """
+        Rebuilds tag_index if another process has changed the posts or tags
+        since it was built, so call it before querying tag_index
+    """
+    if get_index_version(TAG_INDEX_VERSION) != tag_index.version:
+        build_tag_index()
+
+def tag_index_changed():
+    """
+        Tells the other processes tag_index is out of date, once a committed
+        write has been made to it here as well
+    """
+    tag_index.changed(bump_index_version(TAG_INDEX_VERSION))
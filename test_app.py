@@ -1,19 +1,48 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
 from unittest import TestCase
+from urllib.parse import quote
+from flask import Flask, request
+from testing import configure_test_database, TransactionTestCase
+
+# the app connects to the db as soon as it's imported
+configure_test_database()
+
 from app import app
-from models import db, User, Post
+from models import db, User, Post, Tag, PostTag, PostChunk, FeedEntry, \
+    make_excerpt, get_index_version, bump_index_version, EXCERPT_LENGTH, \
+    CONTENT_CHUNK_SIZE
+from sqlalchemy import create_engine, event, text
+from migrations import create_index_concurrently, add_column, \
+    backfill_column, find_unindexed_foreign_keys, add_post_excerpts, \
+    convert_post_dates_to_utc, bootstrap, upgrade, migration_lock, \
+    schema_migrations, migration_progress, MIGRATIONS
+from feeds import feed_cache, FeedCache, atom_date
+from related import RelatedPosts, related_posts, build_related_posts, \
+    sync_related_posts, RELATED_POSTS_VERSION
+from tag_index import TagIndex, TagQueryError, tag_index, build_tag_index, \
+    sync_tag_index, page_of, PAGE_SIZE, TAG_INDEX_VERSION
+from limits import MemoryBackend, SharedBackend, FakeRedis, init_limits
+from profiler import init_profiler
+from home_feed import build_feed_entries, insert_feed_entries, \
+    make_cursor, HOME_PAGE_SIZE
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///blogly_test"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+app.config["SQLALCHEMY_ECHO"] = False
 app.config["TESTING"] = True
 app.config["DEBUG_TB_HOSTS"] = ["dont-show-debug-toolbar"]
+app.config["RATELIMIT_ENABLED"] = False
 
 db.drop_all()
-db.create_all()
+bootstrap()
 
 base_url = "http://localhost"
 
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(TransactionTestCase):
     """
         Tests for views for Users.
     """
@@ -21,9 +50,7 @@ class UserViewsTestCase(TestCase):
         """
             Adds test users and posts to test db
         """
-        Post.query.delete()
-        User.query.delete()
-        db.session.commit()
+        super().setUp()
 
         # add users
         num_of_users = 3
@@ -69,6 +96,8 @@ class UserViewsTestCase(TestCase):
         db.session.add_all(posts)
         db.session.commit()
         
+        build_feed_entries()
+
         # save info on posts
         self.num_of_posts = num_of_posts
         self.titles = titles
@@ -76,12 +105,6 @@ class UserViewsTestCase(TestCase):
         self.user_ids = user_ids
         self.posts = posts
 
-    def tearDown(self):
-        """
-            Undoes any failed transactions
-        """
-        db.session.rollback()
-    
     # TODO: need to update this test
     def test_show_home_page(self):
         """
@@ -250,13 +273,16 @@ class UserViewsTestCase(TestCase):
             for i in range(self.num_of_posts):
                 test_post = Post.query.filter_by(title=self.titles[i]).one()
                 test_user = User.query.get(test_post.user_id)
+                # the view lets go of the objects the test loaded
+                title, content = test_post.title, test_post.content
+                full_name = test_user.full_name
                 resp = client.get(f"/posts/{test_post.id}")
                 html = resp.get_data(as_text=True)
 
                 self.assertEqual(resp.status_code, 200)
-                self.assertIn(test_post.title, html)
-                self.assertIn(test_post.content, html)
-                self.assertIn(f"By {test_user.full_name}", html)
+                self.assertIn(title, html)
+                self.assertIn(content, html)
+                self.assertIn(f"By {full_name}", html)
 
     def test_show_post_edit_form(self):
         """
@@ -313,4 +339,1031 @@ class UserViewsTestCase(TestCase):
                 Post.query.filter((Post.user_id == test_post.user_id) & \
                     (Post.title != test_post.title)).all()
             for post in other_posts:
-                self.assertIn(post.title, html)
\ No newline at end of file
+                self.assertIn(post.title, html)
+
+class MigrationsTestCase(TestCase):
+    """
+        Tests for the schema migration helpers. These change the schema
+        outside of any transaction, so they commit their test data and clean
+        it up afterwards instead of using TransactionTestCase.
+    """
+    def setUp(self):
+        """
+            Adds a test user with posts to test db
+        """
+        user = User(first_name="Alan", last_name="Alda")
+        db.session.add(user)
+        db.session.commit()
+        posts = [Post(title=title, content="content", user_id=user.id) \
+            for title in ("MASH", "Quote", "Dev")]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # concurrent index builds wait on every open transaction
+        db.session.close()
+
+    def test_find_unindexed_foreign_keys(self):
+        """
+            Tests find_unindexed_foreign_keys() flags a foreign key once its
+            index is dropped, and create_index_concurrently() fixes it
+        """
+        self.assertEqual(find_unindexed_foreign_keys(), [])
+
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_posts_tags_tag_id"))
+        try:
+            self.assertEqual(find_unindexed_foreign_keys(), \
+                [("posts_tags", ("tag_id",), "tags")])
+
+            create_index_concurrently("ix_posts_tags_tag_id", "posts_tags", \
+                ["tag_id"])
+            self.assertEqual(find_unindexed_foreign_keys(), [])
+        finally:
+            # put the index back even if a check failed, so later tests and
+            # runs don't find the db missing it
+            with db.engine.begin() as conn:
+                conn.execute(text("CREATE INDEX IF NOT EXISTS " \
+                    "ix_posts_tags_tag_id ON posts_tags (tag_id)"))
+
+    def test_bootstrap(self):
+        """
+            Tests bootstrap() leaves a db with tables alone, and the db it
+            created has every migration recorded
+        """
+        self.assertFalse(bootstrap())
+        self.assertEqual(upgrade(), [])
+        with db.engine.connect() as conn:
+            applied = [row[0] for row in conn.execute( \
+                schema_migrations.select().order_by(schema_migrations.c.id))]
+        self.assertEqual(applied, [migration[0] for migration in MIGRATIONS])
+
+    def test_migration_lock(self):
+        """
+            Tests upgrade() waits for another process changing the schema
+        """
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("only Postgres is locked")
+
+        upgraded = Event()
+        with migration_lock():
+            waiting = Thread(target=lambda: (upgrade(), upgraded.set()))
+            waiting.start()
+            self.assertFalse(upgraded.wait(0.5))
+        waiting.join(5)
+        self.assertTrue(upgraded.is_set())
+
+    def test_backfill_column(self):
+        """
+            Tests backfill_column() fills in a new column in batches
+        """
+        add_column("posts", "title_copy", "TEXT")
+        try:
+            updated = backfill_column("posts", "title_copy", "title", \
+                batch_size=2, pause=0)
+
+            self.assertEqual(updated, 3)
+            with db.engine.connect() as conn:
+                missing = conn.execute(text(
+                    "SELECT COUNT(*) FROM posts "
+                    "WHERE title_copy IS NULL OR title_copy != title"
+                )).scalar()
+            self.assertEqual(missing, 0)
+        finally:
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE posts DROP COLUMN title_copy"))
+
+    def test_add_post_excerpts(self):
+        """
+            Tests add_post_excerpts() fills in excerpts just like
+            make_excerpt(), and the feed entries from them
+        """
+        content = "word " * 39 + "end\t\n   \r" + "x" * 3000
+        with db.engine.begin() as conn:
+            conn.execute(text("UPDATE posts SET excerpt = NULL"))
+            conn.execute(text(
+                "UPDATE posts SET content = :content WHERE title = 'MASH'"
+            ), content=content)
+
+        add_post_excerpts()
+
+        for post in Post.query.all():
+            self.assertEqual(post.excerpt, make_excerpt(post.content))
+            entry = FeedEntry.query.get(post.id)
+            self.assertEqual(entry.excerpt, post.excerpt)
+            self.assertEqual(entry.created_at, post.created_at)
+            self.assertEqual(entry.friendly_date, post.friendly_date)
+            self.assertEqual(entry.tag_names, [])
+        self.assertTrue(Post.query.filter_by(title="MASH").one() \
+            .excerpt.endswith("end..."))
+
+    def test_convert_post_dates_to_utc(self):
+        """
+            Tests convert_post_dates_to_utc() carries on from where a stopped
+            run got to, leaves posts added after it started alone, and doesn't
+            convert anything again when it's run once more
+        """
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("only Postgres stored local dates")
+
+        ids = [post.id for post in Post.query.order_by(Post.id)]
+        build_feed_entries()
+        noon = datetime(2020, 1, 5, 12, 0)
+        with db.engine.begin() as conn:
+            conn.execute(text("UPDATE posts SET created_at = :noon"), \
+                noon=noon)
+            conn.execute(migration_progress.delete().where( \
+                migration_progress.c.id == "0005_utc_post_dates"))
+            # the first post was converted before the run stopped, and the
+            # last was added with the UTC default after it started
+            conn.execute(migration_progress.insert().values( \
+                id="0005_utc_post_dates", max_id=ids[1], last_id=ids[0]))
+
+        convert_post_dates_to_utc("America/New_York", batch_size=1, pause=0)
+        convert_post_dates_to_utc("America/New_York", batch_size=1, pause=0)
+
+        five_pm = datetime(2020, 1, 5, 17, 0)
+        dates = [Post.query.get(post_id).created_at for post_id in ids]
+        self.assertEqual(dates, [noon, five_pm, noon])
+        entry = FeedEntry.query.get(ids[1])
+        self.assertEqual(entry.created_at, five_pm)
+        self.assertEqual(entry.friendly_date, "Sun Jan 05 2020, 05:00 PM")
+
+    def tearDown(self):
+        """
+            Removes the test user and posts
+        """
+        FeedEntry.query.delete()
+        PostChunk.query.delete()
+        Post.query.delete()
+        User.query.delete()
+        db.session.commit()
+        db.session.close()
+
+class FeedViewsTestCase(TransactionTestCase):
+    """
+        Tests for views for Atom feeds.
+    """
+    def setUp(self):
+        """
+            Adds a test user with tagged posts to test db
+        """
+        super().setUp()
+
+        user = User(first_name="Alan", last_name="Alda")
+        tag = Tag(name="funny")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        posts = [Post(title=title, content="content", user_id=user.id) \
+            for title in ("MASH", "Quote")]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add(PostTag(post_id=posts[0].id, tag_id=tag.id))
+        db.session.commit()
+
+        self.user = user
+        self.tag = tag
+        self.posts = posts
+
+    def test_show_feed(self):
+        """
+            Tests show_feed() lists every post
+        """
+        with app.test_client() as client:
+            resp = client.get("/feed.xml")
+            xml = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "application/atom+xml")
+            for post in self.posts:
+                self.assertIn(f"<title>{post.title}</title>", xml)
+                self.assertIn(f"/posts/{post.id}", xml)
+            self.assertIn("<name>Alan Alda</name>", xml)
+
+    def test_show_tag_and_user_feeds(self):
+        """
+            Tests show_tag_feed(tag_id) only lists posts with the tag and
+            show_user_feed(user_id) lists the user's posts
+        """
+        with app.test_client() as client:
+            resp = client.get(f"/tags/{self.tag.id}/feed.xml")
+            xml = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<title>MASH</title>", xml)
+            self.assertNotIn("<title>Quote</title>", xml)
+
+            resp = client.get(f"/users/{self.user.id}/feed.xml")
+            xml = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<title>MASH</title>", xml)
+            self.assertIn("<title>Quote</title>", xml)
+
+            resp = client.get("/users/0/feed.xml")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_feed_conditional_request(self):
+        """
+            Tests a feed answers with 304 until a post is added
+        """
+        with app.test_client() as client:
+            resp = client.get("/feed.xml")
+            etag = resp.headers["ETag"]
+
+            resp = client.get("/feed.xml", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            data = {"title": "Comedy", "content": "It's easier than tragedy"}
+            client.post(f"/users/{self.user.id}/posts/new", data=data)
+
+            resp = client.get("/feed.xml", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Comedy", resp.get_data(as_text=True))
+
+    def test_feed_versions_shared(self):
+        """
+            Tests a feed cached by one process isn't served once another
+            process invalidates it
+        """
+        cache, other_cache = FeedCache(), FeedCache()
+        etag = cache.etag("all")
+        cache.set("all", etag, "<feed/>", datetime.utcnow())
+        self.assertEqual(cache.get("all", cache.etag("all"))[0], "<feed/>")
+
+        other_cache.invalidate(["user-1"])
+        self.assertIsNotNone(cache.get("all", cache.etag("all")))
+        other_cache.invalidate(["all"])
+        self.assertIsNone(cache.get("all", cache.etag("all")))
+
+        cache.set("all", cache.etag("all"), "<feed/>", datetime.utcnow())
+        other_cache.clear()
+        self.assertIsNone(cache.get("all", cache.etag("all")))
+
+    def test_feed_ids_and_dates(self):
+        """
+            Tests feed and entry ids are tag: URIs that don't depend on the
+            host, and dates are in UTC
+        """
+        with app.test_client() as client:
+            xml = client.get("/feed.xml").get_data(as_text=True)
+            other_xml = client.get("/feed.xml", \
+                base_url="http://blogly.example").get_data(as_text=True)
+
+        post = self.posts[0]
+        self.assertIn("<id>tag:blogly,2020:feeds/all</id>", xml)
+        self.assertIn(f"<id>tag:blogly,2020:posts/{post.id}</id>", xml)
+        self.assertIn(f"<id>tag:blogly,2020:posts/{post.id}</id>", other_xml)
+        self.assertIn(f"<updated>{atom_date(post.created_at)}</updated>", xml)
+        self.assertLess(abs(post.created_at - datetime.utcnow()), \
+            timedelta(minutes=1))
+
+class RelatedPostsTestCase(TestCase):
+    """
+        Tests for related posts.
+    """
+    def setUp(self):
+        """
+            Sets up the posts_tags rows used by the tests, as (post id, tag id)
+        """
+        self.rows = ((1, 1), (2, 1), (2, 2), (2, 4), (3, 3), (3, 4), (4, 4))
+
+    def test_build(self):
+        """
+            Tests build() ranks posts sharing more tags first, then newer posts
+        """
+        related = RelatedPosts()
+        related.build(*zip(*self.rows))
+
+        self.assertEqual(related.get(2), [4, 3, 1])
+        self.assertEqual(related.get(3), [4, 2])
+        self.assertEqual(related.get(1), [2])
+        self.assertEqual(related.get(5), [])
+        self.assertEqual(related.related_tags(4), [1, 2, 3])
+
+    def test_build_in_parts(self):
+        """
+            Tests build() gives the same results when it has to count the
+            shared tags against a few posts at a time
+        """
+        related = RelatedPosts()
+        related.build(*zip(*self.rows))
+        in_parts = RelatedPosts(max_pairs=1)
+        in_parts.build(*zip(*self.rows))
+
+        for post_id in range(1, 6):
+            self.assertEqual(in_parts.get(post_id), related.get(post_id))
+        self.assertEqual(in_parts.related.shape, (5, related.size))
+
+    def test_update_matches_build(self):
+        """
+            Tests changing tags with update(), remove() and remove_tag() gives
+            the same results as building from the changed rows
+        """
+        related = RelatedPosts()
+        related.build(*zip(*self.rows))
+        related.update(5, [3, 4])
+        related.update(2, [1, 3])
+        related.remove(1)
+        related.remove_tag(4)
+        related.refresh_stale()
+
+        rows = ((2, 1), (2, 3), (3, 3), (5, 3))
+        expected = RelatedPosts()
+        expected.build(*zip(*rows))
+
+        for post_id in range(1, 6):
+            self.assertEqual(related.get(post_id), expected.get(post_id))
+        for tag_id in range(1, 5):
+            self.assertEqual(related.related_tags(tag_id), \
+                expected.related_tags(tag_id))
+        cooccurrence = related.cooccurrence.toarray()
+        self.assertEqual(cooccurrence[:4, :4].tolist(), \
+            expected.cooccurrence.toarray().tolist())
+        self.assertFalse(cooccurrence[4:, :].any())
+
+    def test_patched_updates(self):
+        """
+            Tests update() only rescores the changed post and patches the
+            others, leaving posts that may have lost a better candidate stale
+            until refresh_stale()
+        """
+        related = RelatedPosts(size=1)
+        related.build([1, 2, 3, 3], [1, 1, 1, 2])
+        self.assertEqual(related.get(1), [3])
+
+        # post 3 drops out of the full lists of posts 1 and 2, which each
+        # had the other as a candidate that wasn't kept
+        related.update(3, [2])
+        self.assertEqual(related.get(1), [])
+        self.assertEqual(related.get(3), [])
+        self.assertEqual(related.stale, {1, 2})
+
+        self.assertEqual(related.refresh_stale(), 2)
+        self.assertEqual(related.get(1), [2])
+        self.assertEqual(related.get(2), [1])
+
+        # raising a score is patched in exactly
+        related.update(2, [1, 2])
+        self.assertEqual(related.get(3), [2])
+        self.assertEqual(related.stale, set())
+
+class RelatedPostsViewsTestCase(TransactionTestCase):
+    """
+        Tests for views showing related posts.
+    """
+    def test_show_post_details_related(self):
+        """
+            Tests show_post_details(post_id) links to posts sharing a tag
+        """
+        user = User(first_name="Alan", last_name="Alda")
+        tag = Tag(name="funny")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        posts = [Post(title=title, content="content", user_id=user.id) \
+            for title in ("MASH", "Quote", "Dev")]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add_all([PostTag(post_id=post.id, tag_id=tag.id) \
+            for post in posts[:2]])
+        db.session.commit()
+        build_related_posts()
+        ids = [post.id for post in posts]
+
+        with app.test_client() as client:
+            resp = client.get(f"/posts/{ids[0]}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<a href="/posts/{ids[1]}">Quote</a>', html)
+            self.assertNotIn(f'<a href="/posts/{ids[2]}">', html)
+
+    def test_writes_in_other_processes(self):
+        """
+            Tests related posts are rebuilt once another process changes the
+            posts' tags, but not after a change made through this one
+        """
+        user = User(first_name="Alan", last_name="Alda")
+        tag = Tag(name="funny")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        posts = [Post(title=title, content="content", user_id=user.id) \
+            for title in ("MASH", "Quote")]
+        db.session.add_all(posts)
+        db.session.commit()
+        ids = [post.id for post in posts]
+        build_related_posts()
+
+        # another process tags both posts
+        db.session.add_all([PostTag(post_id=post_id, tag_id=tag.id) \
+            for post_id in ids])
+        db.session.commit()
+        bump_index_version(RELATED_POSTS_VERSION)
+
+        with app.test_client() as client:
+            html = client.get(f"/posts/{ids[0]}").get_data(as_text=True)
+            self.assertIn(f'<a href="/posts/{ids[1]}">Quote</a>', html)
+
+            client.post(f"/posts/{ids[1]}/delete")
+        version = related_posts.version
+        sync_related_posts()
+        self.assertIs(related_posts.version, version)
+        self.assertEqual(related_posts.version, \
+            get_index_version(RELATED_POSTS_VERSION))
+        self.assertEqual(related_posts.get(ids[0]), [])
+
+    def test_teardown_empties_app_state(self):
+        """
+            Tests the related posts, tag index and feeds built from a test's
+            rows are forgotten once the rows are rolled back
+        """
+        user = User(first_name="Alan", last_name="Alda")
+        tag = Tag(name="funny")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        posts = [Post(title=title, content="content", user_id=user.id) \
+            for title in ("MASH", "Quote")]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add_all([PostTag(post_id=post.id, tag_id=tag.id) \
+            for post in posts])
+        db.session.commit()
+        build_related_posts()
+        build_tag_index()
+        with app.test_client() as client:
+            client.get("/feed.xml")
+        post_id = posts[0].id
+        self.assertEqual(related_posts.get(post_id), [posts[1].id])
+
+        self.tearDown()
+        try:
+            self.assertEqual(related_posts.get(post_id), [])
+            self.assertEqual(list(tag_index.query("")), [])
+            self.assertEqual(feed_cache.feeds, {})
+        finally:
+            self.setUp()
+
+class TagIndexTestCase(TestCase):
+    """
+        Tests for filtering posts by tags.
+    """
+    def setUp(self):
+        """
+            Builds a tag index for the tests
+        """
+        self.index = TagIndex()
+        self.index.build(
+            [1, 2, 3, 4],
+            [(1, "funny"), (2, "very funny"), (3, "work"), (4, "profound")],
+            [(1, 1), (2, 1), (2, 2), (2, 4), (3, 3), (3, 4)]
+        )
+
+    def test_query(self):
+        """
+            Tests query() handles AND, OR and NOT clauses
+        """
+        self.assertEqual(list(self.index.query("")), [1, 2, 3, 4])
+        self.assertEqual(list(self.index.query("funny,profound")), [2])
+        self.assertEqual(list(self.index.query("profound,-work")), [2])
+        self.assertEqual(list(self.index.query("funny|work")), [1, 2, 3])
+        self.assertEqual(list(self.index.query("-funny")), [3, 4])
+        self.assertEqual(list(self.index.query("missing")), [])
+        with self.assertRaises(TagQueryError):
+            self.index.query("funny|")
+
+    def test_updates(self):
+        """
+            Tests set_post(), remove_post(), set_tag() and remove_tag() keep the
+            index current
+        """
+        self.index.set_post(5, [3])
+        self.index.set_post(2, [1])
+        self.index.remove_post(1)
+        self.index.set_tag(3, "job")
+        self.index.set_tag(5, "sad")
+        self.index.remove_tag(4)
+
+        self.assertEqual(list(self.index.query("job")), [3, 5])
+        self.assertEqual(list(self.index.query("work")), [])
+        self.assertEqual(list(self.index.query("funny")), [2])
+        self.assertEqual(list(self.index.query("profound")), [])
+        self.assertEqual(list(self.index.query("-sad")), [2, 3, 4, 5])
+
+    def test_page_of(self):
+        """
+            Tests page_of() pages through posts newest first
+        """
+        matches = TagIndex()
+        matches.build(range(1, PAGE_SIZE + 3), [], [])
+        post_ids = matches.query("")
+
+        self.assertEqual(page_of(post_ids, 1), \
+            (list(range(PAGE_SIZE + 2, 2, -1)), 2))
+        self.assertEqual(page_of(post_ids, 2), ([2, 1], 2))
+        self.assertEqual(page_of(post_ids, 3), ([], 2))
+
+class TagIndexViewsTestCase(TransactionTestCase):
+    """
+        Tests for views filtering posts by tags.
+    """
+    def test_show_filtered_posts(self):
+        """
+            Tests show_filtered_posts() lists the posts matching the query
+        """
+        user = User(first_name="Alan", last_name="Alda")
+        tags = [Tag(name="funny"), Tag(name="work")]
+        db.session.add_all([user] + tags)
+        db.session.commit()
+        posts = [Post(title=title, content="content", user_id=user.id) \
+            for title in ("MASH", "Quote", "Dev")]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add_all([
+            PostTag(post_id=posts[0].id, tag_id=tags[0].id),
+            PostTag(post_id=posts[1].id, tag_id=tags[0].id),
+            PostTag(post_id=posts[1].id, tag_id=tags[1].id)
+        ])
+        db.session.commit()
+        build_tag_index()
+
+        with app.test_client() as client:
+            resp = client.get("/posts?tags=funny,-work")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<a href="/posts/{posts[0].id}">MASH</a>', html)
+            self.assertNotIn("Quote", html)
+            self.assertNotIn("Dev", html)
+
+    def test_writes_in_other_processes(self):
+        """
+            Tests the tag index is rebuilt once another process changes the
+            posts' tags, but not after a change made through this one
+        """
+        user = User(first_name="Alan", last_name="Alda")
+        tag = Tag(name="funny")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        post = Post(title="MASH", content="content", user_id=user.id)
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.id
+        build_tag_index()
+
+        # another process tags the post
+        db.session.add(PostTag(post_id=post_id, tag_id=tag.id))
+        db.session.commit()
+        bump_index_version(TAG_INDEX_VERSION)
+
+        with app.test_client() as client:
+            html = client.get("/posts?tags=funny").get_data(as_text=True)
+            self.assertIn(f'<a href="/posts/{post_id}">MASH</a>', html)
+
+            client.post("/tags/new", data={"name": "profound"})
+        version = tag_index.version
+        sync_tag_index()
+        self.assertIs(tag_index.version, version)
+        self.assertEqual(tag_index.version, \
+            get_index_version(TAG_INDEX_VERSION))
+
+class LimitsTestCase(TestCase):
+    """
+        Tests for rate limiting and load shedding.
+    """
+    def make_app(self, **config):
+        """
+            Makes an app with limits and a route that waits until self.release
+            is set once self.started is set
+            rtype: Flask
+        """
+        limited_app = Flask(__name__)
+        limited_app.config.update(config)
+        init_limits(limited_app)
+        self.started = Event()
+        self.release = Event()
+
+        @limited_app.route("/", methods=["GET", "POST"])
+        def wait():
+            self.started.set()
+            self.release.wait(5)
+            return "done"
+
+        self.release.set()
+        return limited_app
+
+    def test_backends(self):
+        """
+            Tests both backends allow a burst of capacity hits per key, then
+            say how long until the next token
+        """
+        for backend in (MemoryBackend(), SharedBackend(FakeRedis())):
+            for i in range(3):
+                self.assertEqual(backend.hit("a", 0.5, 3), (True, 0))
+            allowed, retry_after = backend.hit("a", 0.5, 3)
+            self.assertFalse(allowed)
+            self.assertTrue(0 < retry_after <= 2)
+            self.assertEqual(backend.hit("b", 0.5, 3), (True, 0))
+
+    def test_memory_backend_bound(self):
+        """
+            Tests MemoryBackend keeps at most max_buckets, forgetting the least
+            recently used ones
+        """
+        backend = MemoryBackend(max_buckets=3)
+        backend.hit("a", 0.01, 1)
+        for key in ("b", "c", "d", "e"):
+            self.assertEqual(backend.hit(key, 0.01, 1), (True, 0))
+            backend.hit("a", 0.01, 1)
+
+        self.assertEqual(list(backend.buckets), ["d", "e", "a"])
+        self.assertFalse(backend.hit("a", 0.01, 1)[0])
+        self.assertEqual(backend.hit("b", 0.01, 1), (True, 0))
+
+    def test_rate_limit(self):
+        """
+            Tests a client over its limit for a route gets a 429 with
+            Retry-After, while reads have their own limit
+        """
+        limited_app = self.make_app(RATELIMIT_WRITE=(0.01, 2))
+        with limited_app.test_client() as client:
+            self.assertEqual(client.post("/").status_code, 200)
+            self.assertEqual(client.post("/").status_code, 200)
+            resp = client.post("/")
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreater(int(resp.headers["Retry-After"]), 1)
+            self.assertEqual(client.get("/").status_code, 200)
+
+    def test_client_key(self):
+        """
+            Tests clients behind RATELIMIT_PROXIES are limited by their
+            forwarded address, and RATELIMIT_KEY_FUNC can tell clients apart
+            some other way
+        """
+        limited_app = self.make_app(RATELIMIT_WRITE=(0.01, 1), \
+            RATELIMIT_PROXIES=1)
+        with limited_app.test_client() as client:
+            for address in ("10.0.0.1", "10.0.0.2"):
+                resp = client.post("/", headers={"X-Forwarded-For": address})
+                self.assertEqual(resp.status_code, 200)
+            resp = client.post("/", headers={"X-Forwarded-For": "10.0.0.1"})
+            self.assertEqual(resp.status_code, 429)
+
+        limited_app = self.make_app(RATELIMIT_WRITE=(0.01, 1), \
+            RATELIMIT_KEY_FUNC=lambda: request.headers.get("X-Api-Key"))
+        with limited_app.test_client() as client:
+            for key in ("a", "b"):
+                resp = client.post("/", headers={"X-Api-Key": key})
+                self.assertEqual(resp.status_code, 200)
+            resp = client.post("/", headers={"X-Api-Key": "a"})
+            self.assertEqual(resp.status_code, 429)
+
+    def test_load_shedding(self):
+        """
+            Tests requests beyond MAX_CONCURRENT_REQUESTS get a 503 with
+            Retry-After until a slot frees up
+        """
+        limited_app = self.make_app(MAX_CONCURRENT_REQUESTS=1, \
+            ADMISSION_TIMEOUT=0)
+        self.release.clear()
+        busy = Thread(target=lambda: limited_app.test_client().get("/"))
+        busy.start()
+        self.started.wait(5)
+
+        try:
+            resp = limited_app.test_client().get("/")
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+        finally:
+            self.release.set()
+            busy.join()
+
+        self.assertEqual(limited_app.test_client().get("/").status_code, 200)
+
+class ProfilerTestCase(TestCase):
+    """
+        Tests for request profiling.
+    """
+    def setUp(self):
+        """
+            Makes a directory for profiles
+        """
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        """
+            Deletes the profiles
+        """
+        self.directory.cleanup()
+
+    def make_app(self, **config):
+        """
+            Makes an app with profiling and a slow route that runs a query,
+            saving profiles to self.directory
+            rtype: Flask
+        """
+        profiled_app = Flask(__name__)
+        profiled_app.config.update(PROFILE_DIR=self.directory.name, \
+            PROFILE_INTERVAL=0.001)
+        profiled_app.config.update(config)
+        init_profiler(profiled_app)
+        engine = create_engine("sqlite://")
+
+        @profiled_app.route("/slow")
+        def slow():
+            engine.execute("SELECT 1")
+            time.sleep(0.05)
+            return "done"
+
+        @profiled_app.route("/fast")
+        def fast():
+            return "done"
+
+        return profiled_app
+
+    def profiles(self):
+        """
+            Gets the names of the saved profiles
+            rtype: list[str]
+        """
+        return sorted(os.listdir(self.directory.name))
+
+    def test_profile_routes(self):
+        """
+            Tests only routes in PROFILE_ROUTES are profiled, and their
+            profiles are speedscope files with their stacks and SQL
+        """
+        profiled_app = self.make_app(PROFILE_ROUTES=["slow"])
+        with profiled_app.test_client() as client:
+            client.get("/fast")
+            self.assertEqual(self.profiles(), [])
+            client.get("/slow")
+
+        names = self.profiles()
+        self.assertEqual(len(names), 1)
+        self.assertIn("-slow-", names[0])
+        with open(os.path.join(self.directory.name, names[0])) as file:
+            profile = json.load(file)
+
+        self.assertIn("GET /slow", profile["name"])
+        self.assertIn("1 queries", profile["name"])
+        sampled = profile["profiles"][0]
+        self.assertEqual(sampled["type"], "sampled")
+        self.assertEqual(len(sampled["samples"]), len(sampled["weights"]))
+        frame_names = {frame["name"] for frame in profile["shared"]["frames"]}
+        self.assertIn("slow", frame_names)
+        self.assertEqual(len(profile["statements"]), 1)
+        self.assertEqual(profile["statements"][0]["sql"], "SELECT 1")
+        self.assertGreaterEqual(profile["statements"][0]["milliseconds"], 0)
+
+    def test_sample_rate_and_pruning(self):
+        """
+            Tests PROFILE_SAMPLE_RATE profiles other routes, collapsed stacks
+            can be saved, and only the newest PROFILE_MAX_FILES are kept
+        """
+        profiled_app = self.make_app(PROFILE_SAMPLE_RATE=1.0, \
+            PROFILE_FORMAT="collapsed", PROFILE_MAX_FILES=2)
+        with profiled_app.test_client() as client:
+            for i in range(3):
+                client.get("/slow")
+
+        names = self.profiles()
+        self.assertEqual(len(names), 4)
+        collapsed, statements = names[:2]
+        self.assertEqual(statements, \
+            collapsed.replace(".collapsed.txt", ".sql.json"))
+        with open(os.path.join(self.directory.name, collapsed)) as file:
+            lines = file.read().splitlines()
+        with open(os.path.join(self.directory.name, statements)) as file:
+            saved = json.load(file)
+
+        stacks = []
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+            stacks.append(stack)
+        # samples can also land in the request's setup or teardown
+        self.assertTrue(any("slow (" in stack for stack in stacks))
+        self.assertTrue(saved["name"].startswith("GET /slow"))
+        self.assertEqual([statement["sql"] for statement \
+            in saved["statements"]], ["SELECT 1"])
+
+class HomeFeedTestCase(TransactionTestCase):
+    """
+        Tests for the feed entries the home page is read from.
+    """
+    def setUp(self):
+        """
+            Adds a test user and tags to test db
+        """
+        super().setUp()
+
+        user = User(first_name="Alan", last_name="Alda")
+        tags = [Tag(name="funny"), Tag(name="work")]
+        db.session.add_all([user] + tags)
+        db.session.commit()
+
+        self.user = user
+        self.tags = tags
+
+    def add_post(self, client, title, content, tag_names):
+        """
+            Adds a post through the add_post(user_id) view and gets its entry
+            rtype: FeedEntry
+        """
+        data = {"title": title, "content": content}
+        data.update({name: "on" for name in tag_names})
+        client.post(f"/users/{self.user.id}/posts/new", data=data)
+        post = Post.query.filter_by(title=title).one()
+        return FeedEntry.query.get(post.id)
+
+    def test_make_excerpt(self):
+        """
+            Tests make_excerpt() shortens long content only
+        """
+        self.assertEqual(make_excerpt("short"), "short")
+        excerpt = make_excerpt("word " * EXCERPT_LENGTH)
+        self.assertTrue(excerpt.endswith("..."))
+        self.assertLessEqual(len(excerpt), EXCERPT_LENGTH + 3)
+
+    def test_build_feed_entries(self):
+        """
+            Tests build_feed_entries() adds missing entries in batches and
+            keeps existing ones
+        """
+        posts = [Post(title=title, content="content", user_id=self.user.id) \
+            for title in ("MASH", "Quote", "Dev")]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add(FeedEntry(post_id=posts[0].id, user_id=self.user.id, \
+            created_at=posts[0].created_at, title="Kept", excerpt="", \
+            author_name="", friendly_date="", tag_names=[]))
+        db.session.commit()
+
+        build_feed_entries(batch_size=1)
+
+        entries = {entry.post_id: entry for entry in FeedEntry.query}
+        self.assertEqual(entries[posts[0].id].title, "Kept")
+        self.assertEqual(entries[posts[2].id].title, "Dev")
+        self.assertEqual(entries[posts[2].id].author_name, "Alan Alda")
+
+        # entries that were added while a batch was being made are skipped
+        db.session.delete(entries[posts[1].id])
+        db.session.commit()
+        racing = FeedEntry(post_id=posts[1].id, \
+            user_id=self.user.id, created_at=posts[1].created_at, \
+            title="Racing", excerpt="", author_name="", friendly_date="", \
+            tag_names=[])
+        insert_feed_entries([racing, entries[posts[2].id]])
+        self.assertEqual(FeedEntry.query.get(posts[1].id).title, "Racing")
+
+    def test_entries_follow_writes(self):
+        """
+            Tests add_post, edit_post, edit_user, edit_tag, delete_tag and
+            delete_post keep the post's feed entry up to date
+        """
+        with app.test_client() as client:
+            entry = self.add_post(client, "MASH", "I enjoyed it", ["funny"])
+            post_id = entry.post_id
+            self.assertEqual(entry.author_name, "Alan Alda")
+            self.assertEqual(entry.tag_names, ["funny"])
+
+            client.post(f"/posts/{post_id}/edit", data={
+                "title": "M.A.S.H", "content": "Hawkeye", "funny": "on",
+                "work": "on"
+            })
+            entry = FeedEntry.query.get(post_id)
+            self.assertEqual(entry.title, "M.A.S.H")
+            self.assertEqual(entry.excerpt, "Hawkeye")
+            self.assertEqual(entry.tag_names, ["funny", "work"])
+
+            client.post(f"/users/{self.user.id}/edit", data={
+                "first-name": "Alan", "last-name": "Alder", "image-url": ""
+            })
+            client.post(f"/tags/{self.tags[1].id}/edit", data={"name": "job"})
+            entry = FeedEntry.query.get(post_id)
+            self.assertEqual(entry.author_name, "Alan Alder")
+            self.assertEqual(entry.tag_names, ["funny", "job"])
+
+            client.post(f"/tags/{self.tags[0].id}/delete")
+            self.assertEqual(FeedEntry.query.get(post_id).tag_names, ["job"])
+
+            client.post(f"/posts/{post_id}/delete")
+            self.assertIsNone(FeedEntry.query.get(post_id))
+
+    def test_show_home_page_pages(self):
+        """
+            Tests show_home_page() shows the newest posts first, a page at a
+            time
+        """
+        with app.test_client() as client:
+            for i in range(HOME_PAGE_SIZE + 1):
+                self.add_post(client, f"Post number {i}", "content", [])
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn(f"Post number {HOME_PAGE_SIZE}<", html)
+            self.assertNotIn("Post number 0<", html)
+            self.assertNotIn("/?after=", html)
+            older = make_cursor(FeedEntry.query \
+                .filter_by(title="Post number 1").one())
+            self.assertIn(f"/?before={quote(older)}", html)
+
+            html = client.get("/", query_string={"before": older}) \
+                .get_data(as_text=True)
+            self.assertIn("Post number 0<", html)
+            self.assertNotIn("Post number 1<", html)
+            self.assertNotIn("/?before=", html)
+            newer = make_cursor(FeedEntry.query \
+                .filter_by(title="Post number 0").one())
+            self.assertIn(f"/?after={quote(newer)}", html)
+
+            html = client.get("/", query_string={"after": newer}) \
+                .get_data(as_text=True)
+            self.assertIn(f"Post number {HOME_PAGE_SIZE}<", html)
+            self.assertIn("Post number 1<", html)
+            self.assertNotIn("Post number 0<", html)
+            self.assertNotIn("/?after=", html)
+
+class PostContentTestCase(TransactionTestCase):
+    """
+        Tests for loading and streaming posts' content.
+    """
+    def setUp(self):
+        """
+            Adds a test user with a long post to test db
+        """
+        super().setUp()
+
+        user = User(first_name="Alan", last_name="Alda")
+        db.session.add(user)
+        db.session.commit()
+
+        content = "Hawkeye " * 2000
+        post = Post(title="MASH", content=content, user_id=user.id)
+        db.session.add(post)
+        db.session.commit()
+
+        self.user = user
+        self.post = post
+        self.content = content
+
+    def test_excerpt(self):
+        """
+            Tests a post's excerpt is stored and follows its content
+        """
+        self.assertEqual(self.post.excerpt, make_excerpt(self.content))
+        self.post.content = "short"
+        db.session.commit()
+        self.assertEqual(Post.query.get(self.post.id).excerpt, "short")
+
+    def test_content_chunks(self):
+        """
+            Tests content_chunks() loads all of the content from its chunks,
+            which follow the content when it's changed
+        """
+        post_id = self.post.id
+        chunks = list(self.post.content_chunks(per_query=1))
+
+        self.assertEqual([len(chunk) for chunk in chunks], \
+            [CONTENT_CHUNK_SIZE, len(self.content) - CONTENT_CHUNK_SIZE])
+        self.assertEqual("".join(chunks), self.content)
+
+        post = Post.query.get(post_id)
+        post.content = "short"
+        db.session.commit()
+        self.assertEqual(list(post.content_chunks()), ["short"])
+        self.assertEqual(PostChunk.query.filter_by(post_id=post_id).count(), 1)
+
+    def test_listings_defer_content(self):
+        """
+            Tests listing a user's posts and the feed don't load posts' content
+        """
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with app.test_client() as client:
+                self.assertEqual( \
+                    client.get(f"/users/{self.user.id}").status_code, 200)
+                feed = client.get("/feed.xml").get_data(as_text=True)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertTrue(statements)
+        self.assertFalse(any("posts.content" in statement \
+            for statement in statements))
+        self.assertIn(make_excerpt(self.content), feed)
+
+    def test_show_post_details_streams(self):
+        """
+            Tests show_post_details(post_id) streams the whole content
+        """
+        with app.test_client() as client:
+            resp = client.get(f"/posts/{self.post.id}")
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f"<p>{self.content}</p>", html)
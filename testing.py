@@ -0,0 +1,133 @@
+"""Test harness for Blogly."""
+
+import os
+from unittest import TestCase
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool
+
+DEFAULT_TEST_DATABASE_URL = "postgresql:///blogly_test"
+
+def create_database(url):
+    """
+        Creates the Postgres db at url if it doesn't exist yet
+        type url: str
+    """
+    url = make_url(url)
+    name = url.database
+    url.database = "postgres"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM pg_database WHERE datname = :name"
+            ), name=name).first()
+            if not exists:
+                conn.execute(text(f'CREATE DATABASE "{name}"'))
+    finally:
+        engine.dispose()
+
+def use_sqlite_savepoints():
+    """
+        Makes SAVEPOINTs work on SQLite. The sqlite3 module begins and commits
+        transactions on its own, which breaks SAVEPOINT, so it's told not to
+        and SQLAlchemy begins transactions itself instead.
+    """
+    @event.listens_for(Pool, "connect")
+    def disable_sqlite_transactions(dbapi_connection, connection_record):
+        if type(dbapi_connection).__module__ == "sqlite3":
+            dbapi_connection.isolation_level = None
+
+    @event.listens_for(Engine, "begin")
+    def begin_sqlite_transaction(conn):
+        if conn.dialect.name == "sqlite":
+            conn.execute("BEGIN")
+
+def configure_test_database():
+    """
+        Points the app at the test db by setting DATABASE_URL, so it must be
+        called before app is imported. The db is TEST_DATABASE_URL, or
+        "sqlite" for an in memory SQLite db, and defaults to
+        DEFAULT_TEST_DATABASE_URL. When tests run in parallel with
+        pytest-xdist, each worker gets its own Postgres db (which is created
+        if needed), and its own in memory SQLite db since each worker is a
+        separate process.
+        rtype: str
+    """
+    url = os.environ.get("TEST_DATABASE_URL", DEFAULT_TEST_DATABASE_URL)
+    if url == "sqlite":
+        url = "sqlite://"
+
+    if url.startswith("sqlite"):
+        use_sqlite_savepoints()
+    else:
+        worker = os.environ.get("PYTEST_XDIST_WORKER")
+        if worker:
+            url = f"{url}_{worker}"
+            create_database(url)
+
+    os.environ["DATABASE_URL"] = url
+    return url
+
+class TransactionTestCase(TestCase):
+    """
+        Runs each test inside a transaction that is rolled back afterwards, so
+        tests don't need to clean up the db and nothing they do is ever
+        committed. The app's commits release a SAVEPOINT instead, and a new one
+        is started right away, so a rollback only undoes the work since the
+        last commit, just like outside of tests. The in memory copies of the
+        db kept by the app (related posts, the tag index and cached feeds) are
+        emptied afterwards too, since the rows they were made from are gone.
+    """
+    def setUp(self):
+        """
+            Starts the transaction and points db.session at it
+        """
+        # imported here so the test db is configured before the app is
+        from models import db
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.real_session = db.session
+
+        session = db.create_scoped_session(
+            options={"bind": self.connection, "binds": {}}
+        )
+        # the app removes or closes the session, which would end the
+        # savepoint, so only forget or let go of loaded objects instead
+        session.remove = session.expire_all
+        session.close = session.expunge_all
+        session.begin_nested()
+
+        def restart_savepoint(sess, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                sess.expire_all()
+                sess.begin_nested()
+
+        event.listen(session, "after_transaction_end", restart_savepoint)
+        self.restart_savepoint = restart_savepoint
+        db.session = session
+        self.db = db
+
+    def tearDown(self):
+        """
+            Rolls back everything the test did
+        """
+        session = self.db.session
+        self.db.session = self.real_session
+
+        # end the last savepoint, or the connection thinks it's still open
+        event.remove(session, "after_transaction_end", self.restart_savepoint)
+        session.rollback()
+        session.registry().close()
+
+        self.transaction.rollback()
+        self.connection.close()
+
+        from feeds import feed_cache
+        from related import related_posts
+        from tag_index import tag_index
+        related_posts.build([], [])
+        tag_index.build([], [], [])
+        feed_cache.reset()